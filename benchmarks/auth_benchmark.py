@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+auth_benchmark.py
+
+Compare the cost of the different authentication and signing paths in gaetk.handler.
+Run with `make benchmark` to see the timings.
+
+Copyright (c) 2017 HUDORA GmbH. All rights reserved.
+"""
+import base64
+import unittest
+
+import gaetk
+
+from gaetk.lib import _itsdangerous
+from google.appengine.api import memcache
+
+from timing import ROUNDS
+from timing import timeit
+
+
+class AuthBenchmark(unittest.TestCase):
+    """Basic-Auth credential lookup vs. bearer token verification."""
+
+    def setUp(self):
+        gaetk.handler.config.BEARER_TOKEN_KEYS = ['this is the current bearer token key']
+        self.credential = gaetk.handler.NdbCredential.create(uid='benchuser', text='benchmark')
+        self.authorization = 'Basic %s' % base64.b64encode('benchuser:%s' % self.credential.secret)
+        self.token = gaetk.handler.create_bearer_token(self.credential)
+
+    def _basic_auth(self):
+        """What `login_required()` does for HTTP-Basic-Auth."""
+        _auth_type, encoded = self.authorization.split(None, 1)
+        uid, secret = encoded.decode('base64').split(':', 1)
+        credential = gaetk.handler._get_credential(uid)
+        assert credential.secret == secret
+
+    def _basic_auth_cold(self):
+        """Basic-Auth with empty caches, i.e. a datastore read."""
+        gaetk.handler._credential_cache.clear()
+        memcache.flush_all()
+        self._basic_auth()
+
+    def _basic_auth_memcache(self):
+        """Basic-Auth on a new instance, i.e. a memcache read."""
+        gaetk.handler._credential_cache.clear()
+        self._basic_auth()
+
+    def _bearer(self):
+        """What `login_required()` does for bearer tokens."""
+        assert gaetk.handler.get_bearer_credential(self.token)
+
+    def test_benchmark(self):
+        results = [
+            ('basic, datastore', timeit(self._basic_auth_cold, 50)),
+            ('basic, memcache', timeit(self._basic_auth_memcache)),
+            ('basic, instance cache', timeit(self._basic_auth)),
+            ('bearer token', timeit(self._bearer)),
+        ]
+        for name, usec in results:
+            print '%-25s %8.1f us/call' % (name, usec)
+
+    def tearDown(self):
+        self.credential.key.delete()
+        del gaetk.handler.config.BEARER_TOKEN_KEYS
+
+
+class SignerBenchmark(unittest.TestCase):
+    """Sign/verify throughput of fresh vs. shared serializers (e.g. the `gaetkuid` cookie)."""
+
+    key = 'this should be a 32 character key'
+    payload = dict(uid='benchuser', provider='example.appspot.com')
+
+    def _fresh(self):
+        """What `login_user()` used to do: a new serializer per call."""
+        serializer = _itsdangerous.URLSafeTimedSerializer(self.key)
+        _itsdangerous.URLSafeTimedSerializer(self.key).loads(serializer.dumps(self.payload))
+
+    def _shared(self):
+        """Shared serializer with precomputed derived key."""
+        serializer = gaetk.handler.get_serializer(self.key)
+        serializer.loads(serializer.dumps(self.payload))
+
+    def test_benchmark(self):
+        for name, func in [('fresh serializer', self._fresh), ('shared serializer', self._shared)]:
+            usec = timeit(func, ROUNDS * 10)
+            print '%-25s %8.1f us/sign+verify %8d/s' % (name, usec, 1000000 / usec)
+
+
+if __name__ == '__main__':
+    unittest.main()
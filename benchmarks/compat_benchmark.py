@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+compat_benchmark.py
+
+Cost of the db/ndb dispatch in gaetk.compat for a typical export loop.
+Run with `make benchmark` to see the timings.
+
+Copyright (c) 2017 HUDORA GmbH. All rights reserved.
+"""
+import unittest
+
+from gaetk import compat
+
+from google.appengine.ext import db
+from google.appengine.ext import ndb
+
+from timing import timeit
+
+
+class NdbArtikel(ndb.Model):
+    name = ndb.StringProperty()
+    preis = ndb.IntegerProperty()
+
+
+class DbArtikel(db.Model):
+    name = db.StringProperty()
+    preis = db.IntegerProperty()
+
+
+def _legacy_row(obj):
+    """What the compat functions did before the adapter cache."""
+    if hasattr(obj, 'all'):
+        key, properties = obj.key(), obj.properties()
+    else:
+        key, properties = obj.key, obj._properties
+    kind = getattr(obj, '_get_kind', None) or getattr(obj, 'kind')
+    return [kind(), key] + [getattr(obj, name) for name in properties]
+
+
+def _wrapper_row(obj):
+    """Using the compat functions."""
+    return ([compat.xdb_kind(obj), compat.xdb_key(obj)] +
+            [getattr(obj, name) for name in compat.xdb_properties(obj)])
+
+
+class CompatBenchmark(unittest.TestCase):
+
+    def _entities(self, model, key):
+        """helper: 200 unsaved entities with keys"""
+        return [model(key=key(str(i)), name='Artikel %d' % i, preis=i) for i in range(200)]
+
+    def _run(self, label, objs):
+        """helper: compare the three ways of exporting `objs`"""
+        adapter = compat.xdb_adapter(objs[0])
+
+        def adapter_rows():
+            """Adapter resolved once per loop."""
+            return [[adapter.kind, adapter.key(obj)] + [getattr(obj, name) for name in adapter.property_names]
+                    for obj in objs]
+
+        results = [
+            ('legacy', timeit(lambda: [_legacy_row(obj) for obj in objs], 50)),
+            ('compat functions', timeit(lambda: [_wrapper_row(obj) for obj in objs], 50)),
+            ('adapter', timeit(adapter_rows, 50)),
+        ]
+        for name, usec in results:
+            print '%-5s %-20s %8.1f us/200 rows' % (label, name, usec)
+
+    def test_ndb(self):
+        self._run('ndb', self._entities(NdbArtikel, lambda name: ndb.Key(NdbArtikel, name)))
+
+    def test_db(self):
+        self._run('db', self._entities(DbArtikel, lambda name: db.Key.from_path('DbArtikel', name)))
+
+
+if __name__ == '__main__':
+    unittest.main()
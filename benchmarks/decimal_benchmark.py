@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+decimal_benchmark.py
+
+Cost of converting DecimalProperty values to and from the datastore representation.
+Run with `make benchmark` to see the timings.
+
+Copyright (c) 2017 HUDORA GmbH. All rights reserved.
+"""
+import decimal
+import unittest
+
+import gaetk.models
+
+from timing import timeit
+
+
+class DecimalBenchmark(unittest.TestCase):
+    """String storage vs. scaled integers."""
+
+    def setUp(self):
+        self.values = [decimal.Decimal('%d.%02d' % (i, i % 100)) for i in range(2000)]
+        self.strings = [str(value) for value in self.values]
+        self.scaled = gaetk.models.decimals_to_scaled(self.values, 2)
+
+    def test_conversion(self):
+        string_prop = gaetk.models.DecimalProperty()
+        scaled_prop = gaetk.models.DecimalProperty(precision=2)
+        results = [
+            ('string read', timeit(lambda: [string_prop.make_value_from_datastore(v)
+                                            for v in self.strings], 20)),
+            ('scaled read', timeit(lambda: [scaled_prop.make_value_from_datastore(v)
+                                            for v in self.scaled], 20)),
+            ('scaled batch read', timeit(lambda: gaetk.models.scaled_to_decimals(self.scaled, 2), 20)),
+            ('string write', timeit(lambda: [str(v) for v in self.values], 20)),
+            ('scaled batch write', timeit(lambda: gaetk.models.decimals_to_scaled(self.values, 2), 20)),
+        ]
+        for name, usec in results:
+            print '%-20s %10.1f us/2000 values' % (name, usec)
+        self.assertEqual(gaetk.models.scaled_to_decimals(self.scaled, 2), self.values)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,18 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+timing.py - shared helpers for the benchmarks in this directory.
+
+Copyright (c) 2017 HUDORA GmbH. All rights reserved.
+"""
+import time
+
+ROUNDS = 500
+
+
+def timeit(func, rounds=ROUNDS):
+    """Return microseconds per call of `func`."""
+    start = time.time()
+    for _i in xrange(rounds):
+        func()
+    return (time.time() - start) * 1000000.0 / rounds
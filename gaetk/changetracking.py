@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+gaetk/changetracking.py - find out which properties of an entity were changed.
+
+Values are compared in their datastore representation (what `get_value_for_datastore()`
+resp. ndb's base values return). Properties with `auto_now` or `auto_now_add` are ignored,
+they would change on every `put()`. Models derived from `ChangeTrackingModel` (db) or
+`NdbChangeTrackingModel` (ndb) take a snapshot when they are loaded and after they are
+saved, so checking for changes only converts the current values:
+
+    kunde = Kunde.get_by_id('12345')
+    kunde.name = u'Neu'
+    if changed_properties(kunde):
+        kunde.put()
+
+For other models take a snapshot yourself:
+
+    before = snapshot(kunde, ['name'])
+    kunde.name = u'Neu'
+    changed_properties(kunde, before)
+
+Copyright (c) 2017 HUDORA. All rights reserved.
+"""
+from google.appengine.ext import db
+from google.appengine.ext import ndb
+
+
+def _copy(value):
+    """Lists are shared with the model instance, so changing them in place would change the snapshot."""
+    if isinstance(value, list):
+        return list(value)
+    return value
+
+
+def _normalize(value):
+    """`None` and empty lists are the same (db stores empty lists as `None`, ndb uses `[None]`)."""
+    if value is None or value == [] or value == [None]:
+        return None
+    return value
+
+
+def _is_automatic(prop):
+    """Properties set by the datastore layer on every write (`auto_now`) or on creation (`auto_now_add`)."""
+    return bool(getattr(prop, 'auto_now', False) or getattr(prop, 'auto_now_add', False)
+                or getattr(prop, '_auto_now', False) or getattr(prop, '_auto_now_add', False))
+
+
+def _db_snapshot(instance, names=None):
+    """Datastore representation of a db entity."""
+    ret = {}
+    for name, prop in instance.properties().iteritems():
+        if (names is None or name in names) and not _is_automatic(prop):
+            ret[name] = _copy(prop.get_value_for_datastore(instance))
+    return ret
+
+
+def _db_snapshot_from_entity(model_class, entity):
+    """Datastore representation of a db entity, read from a `datastore.Entity`. No conversion needed."""
+    ret = {}
+    for name, prop in model_class.properties().iteritems():
+        if not _is_automatic(prop):
+            ret[name] = _copy(entity.get(prop.name))
+    return ret
+
+
+def _ndb_snapshot(instance, names=None):
+    """Datastore representation of a ndb entity. Values loaded from the datastore are not converted."""
+    ret = {}
+    for prop in instance._properties.itervalues():
+        if isinstance(prop, ndb.ComputedProperty) or _is_automatic(prop):
+            continue
+        if names is None or prop._code_name in names:
+            ret[prop._code_name] = prop._get_base_value_unwrapped_as_list(instance)
+    return ret
+
+
+def snapshot(instance, names=None):
+    """Return the current datastore representation of all (or the given) properties."""
+    if isinstance(instance, ndb.Model):
+        return _ndb_snapshot(instance, names)
+    return _db_snapshot(instance, names)
+
+
+def changed_properties(instance, before=None, names=None):
+    """Return the set of property names whose value differs from `before`.
+
+    `before` defaults to the snapshot taken when the entity was loaded or saved.
+    Without any snapshot (e.g. a new entity) all properties with a value are returned.
+    """
+    if before is None:
+        before = getattr(instance, '_gaetk_snapshot', None) or {}
+    elif names is None:
+        names = before.keys()
+    current = snapshot(instance, names)
+    return set(name for (name, value) in current.iteritems()
+               if _normalize(value) != _normalize(before.get(name)))
+
+
+def mark_unchanged(instance):
+    """Use the current values as reference for `changed_properties()`."""
+    instance._gaetk_snapshot = snapshot(instance)
+
+
+class ChangeTrackingModel(db.Model):
+    """db.Model which remembers the values read from or written to the datastore.
+
+    If you use db.put(instance) call `instance.mark_saved()` afterwards."""
+
+    _gaetk_snapshot = None
+
+    @classmethod
+    def from_entity(cls, entity):
+        """Called for every entity loaded from the datastore."""
+        instance = super(ChangeTrackingModel, cls).from_entity(entity)
+        instance._gaetk_snapshot = _db_snapshot_from_entity(cls, entity)
+        return instance
+
+    def put(self, **kwargs):
+        """Writes the model instance to the datastore."""
+        key = super(ChangeTrackingModel, self).put(**kwargs)
+        self.mark_saved()
+        return key
+
+    def mark_saved(self):
+        """Take the snapshot from the entity just written. Call this after `db.put(instance)`."""
+        self._gaetk_snapshot = _db_snapshot_from_entity(self.__class__, self._entity)
+
+    def changed_properties(self):
+        """Names of the properties changed since loading or saving."""
+        return changed_properties(self)
+
+
+class NdbChangeTrackingModel(ndb.Model):
+    """ndb.Model which remembers the values read from or written to the datastore."""
+
+    _gaetk_snapshot = None
+
+    @classmethod
+    def _from_pb(cls, *args, **kwargs):
+        """Called for every entity loaded from the datastore."""
+        instance = super(NdbChangeTrackingModel, cls)._from_pb(*args, **kwargs)
+        mark_unchanged(instance)
+        return instance
+
+    def _post_put_hook(self, future):
+        """Remember what was written."""
+        if not future.get_exception():
+            mark_unchanged(self)
+
+    def changed_properties(self):
+        """Names of the properties changed since loading or saving."""
+        return changed_properties(self)
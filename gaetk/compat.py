@@ -6,6 +6,8 @@ gaetk/compat.py compability layer for App Engine
 Created by Dr. Maximillian Dornseif on 2014-12-10.
 Copyright (c) 2014, 2016 HUDORA GmbH. All rights reserved.
 """
+import operator
+
 from urllib import unquote
 
 from google.appengine.datastore.datastore_query import Cursor
@@ -14,30 +16,91 @@ from google.appengine.ext import ndb
 from google.appengine.ext.ndb import model
 
 
+class XdbAdapter(object):
+    """db/ndb specific operations for one model class, resolved only once.
+
+    `key(instance)` and `get_by_id_or_name(id_or_name, parent=None, **kwargs)` are bound
+    to the matching db or ndb implementation. Use `xdb_adapter()` to get the (cached) adapter:
+
+        adapter = xdb_adapter(Kunde)
+        for kunde in kunden:
+            row = [adapter.id(kunde)] + [getattr(kunde, name) for name in adapter.property_names]
+    """
+
+    def __init__(self, model_class):
+        self.model_class = model_class
+        self.is_ndb = not hasattr(model_class, 'all')
+        kind = getattr(model_class, '_get_kind', None) or getattr(model_class, 'kind', None)
+        self.kind = kind() if kind else model_class.__name__
+        if self.is_ndb:
+            self._properties = getattr(model_class, '_properties', {})
+            self.key = operator.attrgetter('key')
+            self.get_by_id_or_name = getattr(model_class, 'get_by_id', None)
+        else:
+            self._properties = model_class.properties()
+            self.key = operator.methodcaller('key')
+            self.get_by_id_or_name = model_class.get_by_key_name
+        # ndb.Expando keeps dynamic properties on the instance
+        self._instance_properties = issubclass(model_class, ndb.Expando)
+        self.property_names = self._properties.keys()
+
+    def properties(self, instance=None):
+        """Properties of the model (or an instance)."""
+        if instance is not None and self._instance_properties:
+            return instance._properties
+        return self._properties
+
+    def id(self, instance):
+        """Key-name (or id) of an instance."""
+        if self.is_ndb:
+            return instance.key.id()
+        return instance.key().id_or_name()
+
+    def create_key(self, id_or_name, parent=None):
+        """Key creation. `parent` can be a key or an instance."""
+        if isinstance(parent, (db.Model, ndb.Model)):
+            parent = xdb_adapter(parent).key(parent)
+        if self.is_ndb:
+            return ndb.Key(self.kind, id_or_name, parent=parent)
+        return db.Key.from_path(self.kind, id_or_name, parent=parent)
+
+
+_adapters = {}
+
+
+def xdb_adapter(model_class):
+    """Return the `XdbAdapter` for a model class or instance."""
+    if not isinstance(model_class, type):
+        model_class = model_class.__class__
+    try:
+        return _adapters[model_class]
+    except KeyError:
+        adapter = _adapters[model_class] = XdbAdapter(model_class)
+        return adapter
+
+
 def xdb_create_key(model_class, id_or_name, parent=None):
     """Key creation."""
-    if issubclass(model_class, ndb.Model):
-        return ndb.Key(model_class._get_kind(), id_or_name, parent=parent)
-    else:
-        return db.Key.from_path(model_class.kind(), id_or_name, parent=parent)
+    return xdb_adapter(model_class).create_key(id_or_name, parent=parent)
 
 
 def get_by_id_or_name(model_class, id_or_name, parent=None, **kwargs):
     """Getting by key value."""
-    if issubclass(model_class, ndb.Model):
-        return model_class.get_by_id(id_or_name, parent=parent, **kwargs)
-    else:
-        return model_class.get_by_key_name(id_or_name, parent=parent, **kwargs)
+    return xdb_adapter(model_class).get_by_id_or_name(id_or_name, parent=parent, **kwargs)
+
+
+def get_by_id_or_name_async(model_class, id_or_name, parent=None, **kwargs):
+    """Getting by key value, returns a future. See `gather()`."""
+    adapter = xdb_adapter(model_class)
+    key = adapter.create_key(id_or_name, parent=parent)
+    if adapter.is_ndb:
+        return key.get_async(**kwargs)
+    return db.get_async(key, **kwargs)
 
 
 def xdb_kind(model_class):
     """Get kind (table-name, string) for ndb model class"""
-    kind = getattr(model_class, '_get_kind', None)
-    if not kind:
-        kind = getattr(model_class, 'kind', None)
-        if not kind:
-            return model_class.__name__
-    return kind()
+    return xdb_adapter(model_class).kind
 
 
 def xdb_kind_from_query(query):
@@ -66,20 +129,22 @@ def xdb_get(key):
         return db.get(key)
 
 
+def xdb_get_async(key):
+    """Get an entity, returns a future. See `gather()`."""
+    if isinstance(key, ndb.key.Key):
+        return key.get_async()
+    else:
+        return db.get_async(key)
+
+
 def xdb_is_ndb(model_class):
     """Check if instance is ndb or db."""
-    if hasattr(model_class, 'all'):
-        return False
-    else:
-        return True
+    return xdb_adapter(model_class).is_ndb
 
 
 def xdb_key(instance):
     """Return key."""
-    if xdb_is_ndb(instance):
-        return instance.key
-    else:
-        return instance.key()
+    return xdb_adapter(instance).key(instance)
 
 
 def xdb_id_or_name(key):
@@ -100,10 +165,9 @@ def xdb_to_protobuf(instance):
 
 def xdb_properties(instance):
     """Properties einer Entity."""
-    if xdb_is_ndb(instance):
-        return instance._properties
-    else:
-        return instance.properties()
+    if isinstance(instance, type):
+        return xdb_adapter(instance).properties()
+    return xdb_adapter(instance).properties(instance)
 
 
 def _get_queryset_db(model_class, ordering=None):
@@ -156,6 +220,17 @@ def xdb_query_run(query):
     return query
 
 
+def xdb_query_run_async(query):
+    """Fetch all results of a query, returns a future for a list.
+
+    For db queries the first batch is requested immediately, the rest when `get_result()` is called.
+    """
+    if isinstance(query, ndb.Query):
+        return query.fetch_async()
+    else:
+        return _DbFuture(list, query.run())
+
+
 def xdb_fetch_page(query, limit, offset=None, start_cursor=None):
     """Pagination-ready fetching a some entities."""
 
@@ -189,6 +264,51 @@ def xdb_fetch_page(query, limit, offset=None, start_cursor=None):
     return objects, cursor, more_objects
 
 
+def xdb_fetch_page_async(query, limit, offset=None, start_cursor=None):
+    """Like `xdb_fetch_page()` but returns a future.
+
+    db has no asynchronous API for this, so db queries are executed when calling `get_result()`.
+    """
+    if isinstance(query, ndb.Query):
+        if start_cursor:
+            if isinstance(start_cursor, basestring):
+                start_cursor = Cursor(urlsafe=start_cursor)
+            return query.fetch_page_async(limit, start_cursor=start_cursor)
+        else:
+            return query.fetch_page_async(limit, offset=offset)
+    return _DbFuture(xdb_fetch_page, query, limit, offset=offset, start_cursor=start_cursor)
+
+
+class _DbFuture(object):
+    """Minimal future for db operations without an asynchronous API."""
+
+    def __init__(self, func, *args, **kwargs):
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs
+        self._done = False
+        self._result = None
+
+    def get_result(self):
+        """Execute the operation (once) and return the result."""
+        if not self._done:
+            self._result = self._func(*self._args, **self._kwargs)
+            self._done = True
+        return self._result
+
+
+def gather(*futures):
+    """Wait for several futures returned by the `*_async()` functions and return their results.
+
+        kunde, artikel = gather(
+            compat.get_by_id_or_name_async(Kunde, kundennr),
+            compat.xdb_get_async(artikel_key))
+
+    The datastore requests run concurrently, db and ndb can be mixed.
+    """
+    return [future.get_result() for future in futures]
+
+
 def xdb_iskey(obj):
     u"""obj is a db or an ndb Key"""
     return isinstance(obj, (db.Key, ndb.Key))
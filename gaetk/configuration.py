@@ -16,45 +16,211 @@ None
 >>> configuration.get_config('MY-KEY-NAME')
 u'5711'
 
+Values are cached in the instance and in memcache. Every write bumps a generation
+counter in memcache which invalidates all cached values. Instances check the
+counter every `CONFIG_GENERATION_CHECK_INTERVAL` seconds.
+
+Handlers reading several values per request use `self.config_snapshot`, a read only
+snapshot loaded with a single datastore or memcache call:
+
+>>> configuration.get_config_snapshot().get('MY-KEY-NAME')
+u'5711'
+
 Created by Christian Klein on 2011-11-24.
 Copyright (c) 2011, 2012, 2016, 2017 HUDORA. All rights reserved.
 """
+import collections
 import json
 import logging
+import time
 
 import gaetk.handler
+import gaetk.lib._lru_cache
 
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
 
 
+CONFIG_CACHE_TIMEOUT = 60 * 60
+# Instance local copies are kept shorter, in case the generation counter gets lost
+CONFIG_LOCAL_CACHE_TIMEOUT = 5 * 60
+CONFIG_LOCAL_CACHE_SIZE = 500
+# How long an instance trusts its copy of the generation counter
+CONFIG_GENERATION_CHECK_INTERVAL = 5
+_CONFIG_MISSING = '*missing*'
+_CONFIG_GENERATION_KEY = 'gaetk_config:generation'
+# (generation, key) -> JSON encoded value
+_config_cache = gaetk.lib._lru_cache.TimedLRUCache(CONFIG_LOCAL_CACHE_SIZE)
+# How long a snapshot is used before it is loaded again, changes are noticed earlier
+CONFIG_SNAPSHOT_TIMEOUT = 60
+# (generation, keys) -> ConfigSnapshot
+_snapshot_cache = gaetk.lib._lru_cache.TimedLRUCache(20)
+
+
 class gaetk_Configuration(ndb.Model):
     """Generic configuration object"""
     value = ndb.TextProperty(default=u'', indexed=False)
     updated_at = ndb.DateTimeProperty(auto_now_add=True, auto_now=True)
     created_at = ndb.DateTimeProperty(auto_now_add=True)
 
+    def _post_put_hook(self, future):
+        """Drop all cached values."""
+        invalidate_config()
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        """Drop all cached values."""
+        invalidate_config()
+
+
+def _get_generation():
+    """Current generation of the configuration, checked every few seconds."""
+    generation = _config_cache.get(_CONFIG_GENERATION_KEY)
+    if generation is None:
+        generation = memcache.get(_CONFIG_GENERATION_KEY)
+        if generation is None:
+            # the counter was evicted: start with a number never used before
+            memcache.add(_CONFIG_GENERATION_KEY, int(time.time() * 1000))
+            generation = memcache.get(_CONFIG_GENERATION_KEY) or 0
+        _config_cache.set(_CONFIG_GENERATION_KEY, generation, CONFIG_GENERATION_CHECK_INTERVAL)
+    return generation
+
+
+def invalidate_config():
+    """Drop all cached configuration values.
+
+    Called automatically whenever a `gaetk_Configuration` is written or deleted.
+    Other instances see the change after `CONFIG_GENERATION_CHECK_INTERVAL` seconds.
+    """
+    _config_cache.clear()
+    _snapshot_cache.clear()
+    memcache.incr(_CONFIG_GENERATION_KEY, initial_value=int(time.time() * 1000))
+
+
+def _get_values(keys):
+    """Return a dict of the JSON encoded values for `keys`. Unknown keys are left out."""
+    generation = _get_generation()
+    ret = {}
+    missing = []
+    for key in keys:
+        value = _config_cache.get((generation, key))
+        if value is None:
+            missing.append(key)
+        elif value != _CONFIG_MISSING:
+            ret[key] = value
+    if not missing:
+        return ret
+
+    prefix = 'gaetk_config:%s:' % generation
+    cached = memcache.get_multi(missing, key_prefix=prefix)
+    fetch = [key for key in missing if key not in cached]
+    if fetch:
+        objs = ndb.get_multi([ndb.Key(gaetk_Configuration, key) for key in fetch])
+        fetched = dict((key, obj.value if obj else _CONFIG_MISSING) for (key, obj) in zip(fetch, objs))
+        memcache.set_multi(fetched, key_prefix=prefix, time=CONFIG_CACHE_TIMEOUT)
+        cached.update(fetched)
+    for key, value in cached.items():
+        _config_cache.set((generation, key), value, CONFIG_LOCAL_CACHE_TIMEOUT)
+        if value != _CONFIG_MISSING:
+            ret[key] = value
+    return ret
+
+
+class FrozenDict(collections.Mapping):
+    """Read only dict."""
+
+    def __init__(self, values):
+        self._values = dict(values)
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self._values)
+
+
+def _freeze(value):
+    """Make decoded JSON immutable: lists become tuples, dicts `FrozenDict`s."""
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, dict):
+        return FrozenDict((key, _freeze(item)) for (key, item) in value.iteritems())
+    return value
+
+
+class ConfigSnapshot(FrozenDict):
+    """Read only mapping of configuration keys to their decoded values.
+
+    Snapshots are shared between requests, so lists are returned as tuples
+    and dicts as `FrozenDict`s.
+    """
+
+    def __init__(self, values):
+        super(ConfigSnapshot, self).__init__(
+            (key, _freeze(json.loads(value))) for (key, value) in values.iteritems())
+
+
+def _get_all_values():
+    """Return a dict of all JSON encoded values, loaded with a single query."""
+    generation = _get_generation()
+    cachekey = 'gaetk_config_all:%s' % generation
+    values = memcache.get(cachekey)
+    if values is None:
+        values = dict((obj.key.id(), obj.value) for obj in gaetk_Configuration.query())
+        memcache.set(cachekey, values, CONFIG_CACHE_TIMEOUT)
+    return values
+
+
+def get_config_snapshot(keys=None):
+    """Return a `ConfigSnapshot` of all (or the given) configuration values.
+
+    Snapshots are shared within the instance and replaced after `CONFIG_SNAPSHOT_TIMEOUT`
+    seconds or when the configuration changes. Unlike `get_config()` there are no defaults,
+    use `snapshot.get(key, default)`. Call this in your warmup handler to load it at instance start.
+    """
+    if keys is not None:
+        keys = tuple(sorted(keys))
+    cachekey = (_get_generation(), keys)
+    snapshot = _snapshot_cache.get(cachekey)
+    if snapshot is None:
+        if keys is None:
+            snapshot = ConfigSnapshot(_get_all_values())
+        else:
+            snapshot = ConfigSnapshot(_get_values(keys))
+        _snapshot_cache.set(cachekey, snapshot, CONFIG_SNAPSHOT_TIMEOUT)
+    return snapshot
+
 
 def get_config(key, default=None):
-    """Get configuration value for key"""
+    """Get configuration value for key, `default` if it is not set.
+
+    The default is not written to the datastore: a write would invalidate the cached
+    configuration on all instances. Missing keys are cached like other values.
+    """
 
-    obj = gaetk_Configuration.get_by_id(key)
-    if obj:
-        return json.loads(obj.value)
-    return set_config(key, default)
+    values = _get_values([key])
+    if key in values:
+        return json.loads(values[key])
+    return default
 
 
 def get_config_multi(keys):
     """Get multiple configuration values, no defaults"""
 
-    objs = ndb.get_multi([ndb.Key(gaetk_Configuration, key) for key in keys])
-    return dict((obj.key.id(), obj.value) for obj in objs if obj is not None)
+    return _get_values(keys)
 
 
 def set_config(key, value):
     """Set configuration value for key"""
 
     obj = gaetk_Configuration(id=key, value=json.dumps(value))
-    obj.put()
+    obj.put()  # calls invalidate_config()
     return value
 
 
@@ -52,6 +52,7 @@ from webob.exc import HTTPUnauthorized as HTTP401_Unauthorized
 from webob.exc import HTTPUnsupportedMediaType as HTTP415_UnsupportedMediaType
 
 import gaetk.compat
+import gaetk.lib._lru_cache
 import gaetk.tools
 import jinja2
 import webapp2
@@ -62,7 +63,6 @@ from gaetk.lib._gaesessions import Session
 from gaetk.lib._gaesessions import _tls
 from gaetk.lib._gaesessions import get_current_session
 from gaetk.lib._gaesessions import set_current_session
-from gaetk.lib._lru_cache import lru_cache
 
 logger = logging.getLogger(__name__)
 
@@ -85,6 +85,17 @@ _dummy = [HTTP301_Moved, HTTP302_Found, HTTP303_SeeOther, HTTP307_TemporaryRedir
 
 
 CREDENTIAL_CACHE_TIMEOUT = 600
+# Instance local copies are kept shorter, so changes made on other instances show up soon
+CREDENTIAL_LOCAL_CACHE_TIMEOUT = 60
+CREDENTIAL_LOCAL_CACHE_SIZE = 100
+# How long we remember that a uid does not exist
+CREDENTIAL_NEGATIVE_CACHE_TIMEOUT = 60
+# How long a successfully verified HTTP-Basic `Authorization` header is trusted
+BASIC_AUTH_CACHE_TIMEOUT = 30
+_CREDENTIAL_MISSING = '*missing*'
+# Bearer tokens are signed with the first of `config.BEARER_TOKEN_KEYS`
+BEARER_TOKEN_SALT = 'gaetk.bearer'
+BEARER_TOKEN_TIMEOUT = 60 * 60
 _jinja_env_cache = {}
 
 
@@ -92,6 +103,39 @@ _jinja_env_cache = {}
 WSGIApplication = webapp2.WSGIApplication
 
 
+_credential_cache = gaetk.lib._lru_cache.TimedLRUCache(CREDENTIAL_LOCAL_CACHE_SIZE)
+# sha256(Authorization header) -> credential
+_basic_auth_cache = gaetk.lib._lru_cache.TimedLRUCache(CREDENTIAL_LOCAL_CACHE_SIZE)
+
+
+_serializer_cache = {}
+
+
+def get_serializer(secret_key, salt=b'itsdangerous'):
+    """Return a shared `URLSafeTimedSerializer` for `secret_key` and `salt`.
+
+    Reusing serializers means key derivation and HMAC setup happen only once per key.
+    """
+    cache_key = (secret_key, salt)
+    serializer = _serializer_cache.get(cache_key)
+    if serializer is None:
+        serializer = _itsdangerous.URLSafeTimedSerializer(secret_key, salt=salt)
+        _serializer_cache[cache_key] = serializer
+    return serializer
+
+
+def _set_user_environ(credential):
+    """Make the logged in user known to `google.appengine.api.users`."""
+    if not os.environ.get('USER_ID', None):
+        os.environ['USER_ID'] = credential.uid
+        os.environ['AUTH_DOMAIN'] = 'auth.hudora.de'
+        # os.environ['USER_IS_ADMIN'] = credential.admin
+        if credential.email:
+            os.environ['USER_EMAIL'] = credential.email
+        else:
+            os.environ['USER_EMAIL'] = '%s@auth.hudora.de' % credential.uid
+
+
 def login_user(credential, session, via, response=None):
     """Ensure the system knows that a user has been logged in."""
 
@@ -104,17 +148,10 @@ def login_user(credential, session, via, response=None):
         session['login_via'] = via
     if 'login_time' not in session:
         session['login_time'] = datetime.datetime.now()
-    if not os.environ.get('USER_ID', None):
-        os.environ['USER_ID'] = credential.uid
-        os.environ['AUTH_DOMAIN'] = 'auth.hudora.de'
-        # os.environ['USER_IS_ADMIN'] = credential.admin
-        if credential.email:
-            os.environ['USER_EMAIL'] = credential.email
-        else:
-            os.environ['USER_EMAIL'] = '%s@auth.hudora.de' % credential.uid
+    _set_user_environ(credential)
     if response:
         if hasattr(session, 'base_key'):
-            s = _itsdangerous.URLSafeTimedSerializer(session.base_key)
+            s = get_serializer(session.base_key)
             domain = gaetk.tools.get_cookie_domain()
             uidcookie = s.dumps(dict(uid=credential.uid, provider=os.environ.get('HTTP_HOST', '')))
             response.set_cookie('gaetkuid', uidcookie, domain='.%s' % domain, max_age=60 * 60 * 2)
@@ -125,15 +162,201 @@ def login_user(credential, session, via, response=None):
             credential.uid, session['login_via'], session['login_time'], session.sid)
 
 
-@lru_cache(maxsize=100, typed=True, ttl=CREDENTIAL_CACHE_TIMEOUT)
+def _credential_memcache_key(uid):
+    """Memcache key for the cached credential `uid`."""
+    return 'gaetk_credential:%s' % uid
+
+
 def _get_credential(username):
-    """Helper to read Credentials - can be monkey_patched"""
+    """Helper to read Credentials - can be monkey_patched
+
+    Credentials are cached in the instance and in memcache. Unknown uids are
+    cached as well, so brute force HTTP-Auth attempts don't hit the datastore.
+    """
+    cached = _credential_cache.get(username)
+    if cached is not None:
+        if cached is _CREDENTIAL_MISSING:
+            return None
+        return cached
+
+    cachekey = _credential_memcache_key(username)
+    cached = memcache.get(cachekey)
+    if cached is None:
+        credential = NdbCredential.get_by_id(username)
+        if credential:
+            if not hasattr(credential, 'permissions'):
+                credential.permissions = []
+            cached = credential
+            memcache.add(cachekey, cached, CREDENTIAL_CACHE_TIMEOUT)
+        else:
+            cached = _CREDENTIAL_MISSING
+            memcache.add(cachekey, cached, CREDENTIAL_NEGATIVE_CACHE_TIMEOUT)
+
+    if cached == _CREDENTIAL_MISSING:
+        _credential_cache.set(
+            username, _CREDENTIAL_MISSING,
+            min(CREDENTIAL_NEGATIVE_CACHE_TIMEOUT, CREDENTIAL_LOCAL_CACHE_TIMEOUT))
+        return None
+    get_permission_set(cached)  # precompute while caching
+    _credential_cache.set(username, cached, CREDENTIAL_LOCAL_CACHE_TIMEOUT)
+    return cached
+
+
+def invalidate_credential(uid):
+    """Remove `uid` from the credential caches.
+
+    Called automatically whenever a `NdbCredential` is written or deleted.
+    Other instances see the change after `CREDENTIAL_LOCAL_CACHE_TIMEOUT` seconds.
+    """
+    _credential_cache.delete(uid)
+    _basic_auth_cache.delete_matching(lambda credential: credential.uid == uid)
+    memcache.delete(_credential_memcache_key(uid))
+
+
+def _authorization_cache_key(authorization):
+    """We never keep the plaintext `Authorization` header around."""
+    return hashlib.sha256(authorization).digest()
+
+
+class PermissionSet(frozenset):
+    """Permissions of a credential allowing set lookups instead of list scans.
 
-    credential = NdbCredential.get_by_id(username)
-    if credential:
-        if not hasattr(credential, 'permissions'):
-            credential.permissions = []
-    return credential
+    Understands wildcards: `'*'` grants everything, `'reports.*'` grants
+    `'reports.sales'` and `'reports.sales.daily'`.
+    """
+
+    def __new__(cls, permissions=()):
+        self = super(PermissionSet, cls).__new__(cls, permissions)
+        self.wildcards = frozenset(perm[:-1] for perm in self if perm.endswith('*'))
+        return self
+
+    def __contains__(self, permission):
+        if frozenset.__contains__(self, permission):
+            return True
+        if self.wildcards:
+            if '' in self.wildcards:
+                return True
+            parts = permission.split('.')
+            for i in range(len(parts) - 1, 0, -1):
+                if '.'.join(parts[:i]) + '.' in self.wildcards:
+                    return True
+        return False
+
+    def has_any(self, permissions):
+        """True if at least one of `permissions` is granted."""
+        return any(perm in self for perm in permissions)
+
+    def check(self, permissions):
+        """Batch check - returns a dict `{permission: bool}`. E.g. to render menus."""
+        return dict((perm, perm in self) for perm in permissions)
+
+
+_EMPTY_PERMISSIONS = PermissionSet()
+
+
+def _expand_roles(permissions):
+    """Replace roles from `config.PERMISSION_ROLES` with the permissions they grant.
+
+    Roles might contain other roles. E.g.
+
+        PERMISSION_ROLES = {'buchhaltung': ['einkaufspreise', 'reports.*']}
+    """
+    roles = getattr(config, 'PERMISSION_ROLES', {})
+    expanded = set()
+    todo = list(permissions)
+    while todo:
+        permission = todo.pop()
+        if permission not in expanded:
+            expanded.add(permission)
+            todo.extend(roles.get(permission, []))
+    return expanded
+
+
+def get_permission_set(credential):
+    """Return the `PermissionSet` of `credential`.
+
+    The set is computed once and kept on the credential object until
+    `credential.permissions` is replaced or changes in length.
+    """
+    if credential is None:
+        return _EMPTY_PERMISSIONS
+    permissions = getattr(credential, 'permissions', None) or []
+    cached = getattr(credential, '_permission_set', None)
+    if cached is None or cached[0] is not permissions or cached[1] != len(permissions):
+        cached = (permissions, len(permissions), PermissionSet(_expand_roles(permissions)))
+        credential._permission_set = cached
+    return cached[2]
+
+
+class BearerCredential(object):
+    """Credential decoded from a signed bearer token without any datastore access.
+
+    Provides the attributes of `NdbCredential` needed for authorisation but can't be saved.
+    """
+    # Tokens never carry the secret, but an empty secret means "Account disabled"
+    secret = '*bearer*'
+    text = 'bearer token'
+
+    def __init__(self, uid, permissions=(), admin=False, email=None, tenant=None, expires=None):
+        self.uid = uid
+        self.permissions = list(permissions)
+        self.admin = admin
+        self.email = email
+        self.tenant = tenant
+        self.expires = expires
+
+    def __str__(self):
+        return str(self.uid)
+
+    def __repr__(self):
+        return "<gaetk.BearerCredential %s>" % self.uid
+
+
+def create_bearer_token(credential, ttl=BEARER_TOKEN_TIMEOUT, permissions=None):
+    """Create a token to be sent as `Authorization: Bearer <token>`.
+
+    The token carries uid, permissions and expiry, so `login_required()` can authenticate
+    it by checking the signature alone. `permissions` restricts the token to a subset of
+    the credential's permissions; restricted tokens never grant admin rights.
+
+    Tokens are signed with the first key in `config.BEARER_TOKEN_KEYS` but all keys listed
+    there are accepted. To rotate keys put a new key in front and remove the old one after
+    `ttl` seconds. Tokens can't be revoked individually, so keep `ttl` short.
+    """
+    keys = getattr(config, 'BEARER_TOKEN_KEYS', None)
+    if not keys:
+        raise ValueError('config.BEARER_TOKEN_KEYS is not set')
+    if permissions is None:
+        permissions = credential.permissions
+        admin = credential.admin
+    else:
+        permissions = [perm for perm in permissions if perm in credential.permissions]
+        admin = False
+    payload = dict(
+        uid=credential.uid, permissions=sorted(permissions), admin=admin,
+        email=credential.email, tenant=credential.tenant, exp=int(time.time() + ttl))
+    return get_serializer(keys[0], BEARER_TOKEN_SALT).dumps(payload)
+
+
+def get_bearer_credential(token):
+    """Return a `BearerCredential` for a valid, unexpired `token`, else `None`."""
+    for key in getattr(config, 'BEARER_TOKEN_KEYS', []):
+        try:
+            payload = get_serializer(key, BEARER_TOKEN_SALT).loads(token)
+        except _itsdangerous.BadSignature:
+            continue  # might be signed with an other key
+        except _itsdangerous.BadData as msg:
+            logger.info("invalid bearer token: %s", msg)
+            return None
+        if payload.get('exp', 0) < time.time():
+            logger.info("expired bearer token for %s", payload.get('uid'))
+            return None
+        credential = BearerCredential(
+            payload['uid'], payload.get('permissions', []), payload.get('admin', False),
+            payload.get('email'), payload.get('tenant'), payload['exp'])
+        get_permission_set(credential)
+        return credential
+    return None
 
 
 class Credential(db.Expando):
@@ -175,6 +398,15 @@ class NdbCredential(ndb.Expando):
                                 user=user, admin=admin, **kwargs)
         return ret
 
+    def _post_put_hook(self, future):
+        """Drop cached copies of this credential."""
+        invalidate_credential(self.key.id())
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        """Drop cached copies of this credential."""
+        invalidate_credential(key.id())
+
     def __str__(self):
         return str(self.uid)
 
@@ -190,12 +422,16 @@ class BasicHandler(webapp2.RequestHandler):
     * `self.session` which is based on https://github.com/dound/gae-sessions.
     * `self.login_required()` and `self.is_admin()` for Authentication
     * `self.authchecker()` to be overwritten to fully customize authentication
+    * `self.config_snapshot` - snapshot of `gaetk.configuration` values
     """
 
     # disable session based authentication on demand
     enableSessionAuth = True
     defaultCachingTime = None
     extensions = []
+    # keys loaded into `self.config_snapshot`, `None` means all
+    config_keys = None
+    _config_snapshot = None
 
     def __init__(self, *args, **kwargs):
         """Initialize RequestHandler"""
@@ -213,6 +449,14 @@ class BasicHandler(webapp2.RequestHandler):
         logger.debug("session:%s", self.session)
         self.credential = None
 
+    @property
+    def config_snapshot(self):
+        """Read only snapshot of the configuration, see `gaetk.configuration.get_config_snapshot()`."""
+        if self._config_snapshot is None:
+            from gaetk import configuration
+            self._config_snapshot = configuration.get_config_snapshot(self.config_keys)
+        return self._config_snapshot
+
     def abs_url(self, url):
         """Converts an relative into an absolute URL."""
         if self.request:
@@ -425,7 +669,8 @@ class BasicHandler(webapp2.RequestHandler):
         except jinja2.TemplateNotFound:
             # better error reporting - we want to see the name of the base template
             raise jinja2.TemplateNotFound(template_name)
-        myval = dict(uri=self.request.url, credential=self.credential)
+        myval = dict(uri=self.request.url, credential=self.credential,
+                     permissions=get_permission_set(self.credential))
         myval.update(self.default_template_vars(values))
         self._expire_messages()
         myval.update(dict(_gaetk_messages=self.session.get('_gaetk_messages', [])))
@@ -626,9 +871,14 @@ class BasicHandler(webapp2.RequestHandler):
 
         Returns False, if no user is logged in.
         """
-        if self.credential:
-            return permission in self.credential.permissions
-        return False
+        return permission in get_permission_set(self.credential)
+
+    def has_permissions(self, permissions):
+        """Checks several permissions at once.
+
+        Returns a dict `{permission: bool}`. All False, if no user is logged in.
+        """
+        return get_permission_set(self.credential).check(permissions)
 
     def login_required(self):
         """Returns the currently logged in user and forces login."""
@@ -666,13 +916,31 @@ class BasicHandler(webapp2.RequestHandler):
             # still no session information - try HTTP - Auth
             uid, secret = None, None
             # see if we have HTTP-Basic Auth Data
-            if self.request.headers.get('Authorization'):
+            authorization = self.request.headers.get('Authorization')
+            if authorization and authorization[:7].lower() == 'bearer ':
+                # stateless tokens - checking the signature is enough
+                self.credential = get_bearer_credential(authorization[7:].strip())
+                if not self.credential:
+                    logger.error("failed Bearer-Login from %s", self.request.remote_addr)
+                    raise HTTP401_Unauthorized(
+                        "Invalid Bearer-Token",
+                        headers={b'WWW-Authenticate': b'Bearer realm="API Login"'})
+                _set_user_environ(self.credential)
+            elif authorization:
+                # API clients send the same header with every call. If we verified it
+                # recently we skip credential lookup, session writes and cookie signing.
+                self.credential = _basic_auth_cache.get(_authorization_cache_key(authorization))
+                if self.credential:
+                    _set_user_environ(self.credential)
+            if authorization and not self.credential:
                 secret, uid = self._parse_authorisation()
                 credential = _get_credential(uid.strip() or ' *invalid* ')
                 if credential and credential.secret == secret.strip():
                     # Successful login
                     self.credential = credential
                     login_user(self.credential, self.session, 'HTTP', self.response)
+                    _basic_auth_cache.set(
+                        _authorization_cache_key(authorization), credential, BASIC_AUTH_CACHE_TIMEOUT)
                     logger.debug("HTTP-Login from %s/%s", uid, self.request.remote_addr)
                 else:
                     logger.error(
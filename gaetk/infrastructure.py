@@ -6,13 +6,20 @@ infrastructure.py
 Created by Maximillian Dornseif on 2011-01-07.
 Copyright (c) 2011, 2012, 2016, 2017 Cyberlogi/HUDORA. All rights reserved.
 """
+import collections
+import datetime
+import hashlib
+import itertools
+import json
 import logging
 import os
 import re
+import time
 import zlib
 
 import google.appengine.ext.deferred.deferred
 
+from gaetk import changetracking
 from gaetk import compat
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
@@ -23,44 +30,184 @@ from google.appengine.ext import ndb
 
 # Tasks
 
-def taskqueue_add_multi(qname, url, paramlist, **kwargs):
+# Task payloads larger than this are stored in the datastore. The hard limit is 100 KB for the
+# whole task including url and headers.
+TASK_PAYLOAD_LIMIT = 90000
+# Spilled payloads older than this belong to tasks which are long gone
+TASK_PAYLOAD_MAX_AGE = datetime.timedelta(days=31)
+_SPILLED_PAYLOAD_PREFIX = 'gaetk_TaskPayload:'
+# keyword arguments `deferred.defer()` uses itself, all others are passed to the function
+_DEFER_OPTIONS = frozenset(['_countdown', '_eta', '_name', '_target', '_retry_options', '_url',
+                            '_transactional', '_headers', '_queue'])
+
+
+class gaetk_TaskPayload(ndb.Model):
+    """Payload of a task which was too large for the taskqueue. zlib compressed."""
+    data = ndb.BlobProperty()
+    created_at = ndb.DateTimeProperty(auto_now_add=True)
+
+
+def _spill_payloads(payloads):
+    """Replace payloads larger than `TASK_PAYLOAD_LIMIT` by a reference to a `gaetk_TaskPayload`.
+
+    `payloads` is a list of zlib compressed strings, the large ones are written with a single `put_multi()`.
+    """
+    large = [i for (i, payload) in enumerate(payloads) if len(payload) > TASK_PAYLOAD_LIMIT]
+    if large:
+        keys = ndb.put_multi([gaetk_TaskPayload(data=payloads[i]) for i in large])
+        for i, key in zip(large, keys):
+            payloads[i] = _SPILLED_PAYLOAD_PREFIX + key.urlsafe()
+    return payloads
+
+
+def _spilled_payload_key(body):
+    """Return the key of a spilled payload or `None`."""
+    if body.startswith(_SPILLED_PAYLOAD_PREFIX):
+        return ndb.Key(urlsafe=body[len(_SPILLED_PAYLOAD_PREFIX):])
+    return None
+
+
+def decode_task_payloads(bodies):
+    """Decode the request bodies of tasks created by `taskqueue_add_multi_payload()`.
+
+    Spilled payloads are read with a single `get_multi()`. Call `delete_task_payloads()` when
+    the tasks are done; they stay around until then so a retried task finds them again.
+    """
+    keys = [_spilled_payload_key(body) for body in bodies]
+    spilled_keys = [key for key in keys if key]
+    spilled = dict(zip(spilled_keys, ndb.get_multi(spilled_keys)))
+    ret = []
+    for body, key in zip(bodies, keys):
+        if key:
+            if not spilled[key]:
+                raise RuntimeError('payload %s is missing' % key)
+            body = spilled[key].data
+        ret.append(json.loads(zlib.decompress(body)))
+    return ret
+
+
+def decode_task_payload(body):
+    """Decode the request body of a task created by `taskqueue_add_multi_payload()`.
+
+        data = decode_task_payload(self.request.body)
+        ...
+        delete_task_payloads([self.request.body])
+    """
+    return decode_task_payloads([body])[0]
+
+
+def delete_task_payloads(bodies):
+    """Remove spilled payloads of finished tasks."""
+    ndb.delete_multi([key for key in (_spilled_payload_key(body) for body in bodies) if key])
+
+
+def _run_spilled_task(key):
+    """Execute a deferred task whose pickled data did not fit into the task."""
+    entity = key.get()
+    if entity is None:
+        logging.warn('payload %s is missing, task did already run?', key)
+        return
+    try:
+        deferred.run(zlib.decompress(entity.data))
+    except deferred.PermanentTaskFailure:
+        # the task won't be retried
+        key.delete()
+        raise
+    key.delete()
+
+
+def delete_orphaned_task_payloads(max_age=TASK_PAYLOAD_MAX_AGE):
+    """Remove spilled payloads older than `max_age`, e.g. of tasks deleted from the queue.
+
+    Call this from a cron job now and then. Returns the number of deleted payloads.
+    """
+    query = gaetk_TaskPayload.query(gaetk_TaskPayload.created_at < datetime.datetime.now() - max_age)
+    count = 0
+    for keys in _batches(query.iter(keys_only=True), 500):
+        ndb.delete_multi(keys)
+        count += len(keys)
+    return count
+
+
+def _batches(iterable, size):
+    """Yield lists of up to `size` items without materialising `iterable`."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            break
+        yield batch
+
+
+def _taskqueue_add_pipelined(qname, tasks, max_rpcs=10):
+    """Add `tasks` in batches of 50 with up to `max_rpcs` `Queue.add_async()` calls in flight.
+
+    Tasks which already exist (or did already run) are skipped, the rest of their batch
+    is still added. Other errors are raised after all RPCs in flight are finished.
+    Returns a list of dicts `{'tasks', 'skipped', 'seconds'}` per batch.
+    """
+    queue = taskqueue.Queue(name=qname)
+    inflight = collections.deque()
+    stats = []
+
+    def wait(rpc, batch, start):
+        """Collect the result of one batch."""
+        try:
+            rpc.get_result()
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            pass
+        skipped = len([task for task in batch if not task.was_enqueued])
+        if skipped:
+            logging.info('%d of %d tasks already existed', skipped, len(batch))
+        stats.append(dict(tasks=len(batch), skipped=skipped, seconds=time.time() - start))
+
+    try:
+        for batch in _batches(tasks, 50):
+            if len(inflight) >= max_rpcs:
+                wait(*inflight.popleft())
+            inflight.append((queue.add_async(batch), batch, time.time()))
+        while inflight:
+            wait(*inflight.popleft())
+    finally:
+        # a batch failed: don't leave the other RPCs unfinished
+        for rpc, _batch, _start in inflight:
+            rpc.wait()
+    return stats
+
+
+def taskqueue_add_multi(qname, url, paramlist, _max_rpcs=10, **kwargs):
     """Adds more than one Task to the same Taskqueue/URL.
 
-    tasks = []
-    for kdnnr in kunden.get_changed():
-        tasks.append(dict(kundennr=kdnnr))
-    taskqueue_add_multi('softmq', '/some/path', tasks)
+    def tasks():
+        for kdnnr in kunden.get_changed():
+            yield dict(kundennr=kdnnr)
+    taskqueue_add_multi('softmq', '/some/path', tasks())
+
+    `paramlist` can be any iterable. Batches are added asynchronously with up to
+    `_max_rpcs` RPCs in flight. Returns per-batch statistics, see `_taskqueue_add_pipelined()`.
     """
 
-    tasks = []
-    for params in paramlist:
-        tasks.append(taskqueue.Task(url=url, params=params, **kwargs))
-        # Batch Addition to Taskqueue
-        if len(tasks) >= 50:
-            taskqueue.Queue(name=qname).add(tasks)
-            tasks = []
-    if tasks:
-        taskqueue.Queue(name=qname).add(tasks)
+    tasks = (taskqueue.Task(url=url, params=params, **kwargs) for params in paramlist)
+    return _taskqueue_add_pipelined(qname, tasks, _max_rpcs)
 
 
-def taskqueue_add_multi_payload(name, url, payloadlist, **kwargs):
+def taskqueue_add_multi_payload(name, url, payloadlist, _max_rpcs=10, **kwargs):
     """like taskqueue_add_multi() but transmit a json encoded payload instead a query parameter.
 
-    In the Task handler you can get the data via zdata = json.loads(self.request.body)`.
+    In the Task handler you can get the data via `decode_task_payload(self.request.body)`.
+    Payloads larger than `TASK_PAYLOAD_LIMIT` are stored in the datastore, see `decode_task_payloads()`.
     See http://code.google.com/appengine/docs/python/taskqueue/tasks.html"""
 
     import huTools.hujson
-    tasks = []
-    for payload in payloadlist:
-        payload = huTools.hujson.dumps(payload)
-        payload = zlib.compress(payload)
-        tasks.append(taskqueue.Task(url=url, payload=payload, **kwargs))
-        # Patch Addition to Taskqueue
-        if len(tasks) >= 50:
-            taskqueue.Queue(name=name).add(tasks)
-            tasks = []
-    if tasks:
-        taskqueue.Queue(name=name).add(tasks)
+
+    def tasks():
+        """Encode payloads on the fly."""
+        for batch in _batches(payloadlist, 50):
+            payloads = _spill_payloads([zlib.compress(huTools.hujson.dumps(payload)) for payload in batch])
+            for payload in payloads:
+                yield taskqueue.Task(url=url, payload=payload, **kwargs)
+
+    return _taskqueue_add_pipelined(name, tasks(), _max_rpcs)
 
 
 def defer(obj, *args, **kwargs):
@@ -75,6 +222,17 @@ def defer(obj, *args, **kwargs):
           - url: /_ah/queue/deferred(.*)
             script: google.appengine.ext.deferred.deferred.application
             login: admin
+
+    If the pickled call is larger than `TASK_PAYLOAD_LIMIT` it is stored in the datastore
+    and deleted after execution, see also `delete_orphaned_task_payloads()`.
+
+    `_coalesce=seconds` collapses identical calls (same function and arguments) within a
+    time window of that length into a single task which runs at the end of the window:
+
+        defer(reindex, kunde.key, _coalesce=60)
+
+    The task name is derived from the pickled call, so pass keys or ids, not entities.
+    Coalesced tasks can't be `_transactional`.
     """
     def to_str(value):
         """Convert all datatypes to str"""
@@ -95,12 +253,37 @@ def defer(obj, *args, **kwargs):
     if _is_production():
         # we only route to the workers backend/module on production machines
         kwargs["_target"] = kwargs.pop("_target", 'workers')
+    coalesce = kwargs.pop('_coalesce', None)
+    options = dict((key, kwargs.pop(key)) for key in kwargs.keys() if key in _DEFER_OPTIONS)
+
+    pickled = deferred.serialize(obj, *args, **kwargs)
+    if coalesce:
+        if options.get('_transactional'):
+            raise ValueError('coalesced tasks are named and named tasks can not be transactional')
+        now = time.time()
+        bucket = int(now // coalesce)
+        options['_name'] = '%s-%s-%d-%d' % (
+            re.sub(r'[^A-Za-z0-9_-]+', '', obj.__name__)[:100], hashlib.sha1(pickled).hexdigest(),
+            coalesce, bucket)
+        if '_eta' not in options and '_countdown' not in options:
+            # run at the end of the window so the task sees all changes made within it
+            options['_countdown'] = (bucket + 1) * coalesce - now
+
+    spilled = None
+    if len(pickled) > TASK_PAYLOAD_LIMIT:
+        spilled = gaetk_TaskPayload(data=zlib.compress(pickled)).put()
+        call = (_run_spilled_task, spilled)
+    else:
+        # the call is pickled already, `deferred.run()` unpickles it in the task
+        call = (deferred.run, pickled)
     try:
-        return deferred.defer(obj, *args, **kwargs)
+        return deferred.defer(*call, **options)
     except taskqueue.TaskAlreadyExistsError:
         logging.info('Task already exists')
     except taskqueue.TombstonedTaskError:
         logging.info('Task did already run')
+    if spilled:
+        spilled.delete()
 
 
 def _is_production():
@@ -128,13 +311,75 @@ def query_iterator(query, limit=50):
             break
 
 
+_NDB_CONSTRUCTOR_ARGS = frozenset(['key', 'id', 'parent', 'app', 'namespace'])
+_copiers = {}
+
+
+def _copy_value(value):
+    """Lists must not be shared between the copies."""
+    if isinstance(value, list):
+        return list(value)
+    return value
+
+
+def _make_ndb_copier(klass):
+    """Copy the internal values of a ndb entity without converting or validating them again."""
+    names = frozenset(prop._name for prop in klass._properties.itervalues()
+                      if not isinstance(prop, ndb.ComputedProperty))
+
+    def copier(e, extra_args):
+        """Closure."""
+        new = klass(**dict((k, v) for (k, v) in extra_args.iteritems() if k in _NDB_CONSTRUCTOR_ARGS))
+        new._values.update(
+            (name, _copy_value(value)) for (name, value) in e._values.iteritems() if name in names)
+        new.populate(**dict((k, v) for (k, v) in extra_args.iteritems() if k not in _NDB_CONSTRUCTOR_ARGS))
+        return new
+    return copier
+
+
+def _make_db_copier(klass):
+    """Copy the raw attribute values of a db entity. Avoids dereferencing `ReferenceProperty`s."""
+    attrs = [(name, prop._attr_name()) for (name, prop) in klass.properties().iteritems()]
+
+    def copier(e, extra_args):
+        """Closure."""
+        props = dict((name, _copy_value(getattr(e, attr, None))) for (name, attr) in attrs)
+        props.update(extra_args)
+        return klass(**props)
+    return copier
+
+
+def _get_copier(klass):
+    """Build the copy function for `klass` only once."""
+    copier = _copiers.get(klass)
+    if copier is None:
+        if issubclass(klass, ndb.Model):
+            copier = _make_ndb_copier(klass)
+        else:
+            copier = _make_db_copier(klass)
+        _copiers[klass] = copier
+    return copier
+
+
 def copy_entity(e, **extra_args):
     """Copy entity but change values in kwargs."""
     # see https://stackoverflow.com/a/2712401
-    klass = e.__class__
-    props = dict((v._code_name, v.__get__(e, klass)) for v in klass._properties.itervalues() if type(v) is not ndb.ComputedProperty)
-    props.update(extra_args)
-    return klass(**props)
+    return _get_copier(e.__class__)(e, extra_args)
+
+
+def copy_entities(entities, keys=None, **extra_args):
+    """Copy many entities, e.g. for versioning.
+
+    If `keys` is given the copies get those keys, otherwise they have no key.
+    All copies get the values in `extra_args`. Nothing is written to the datastore.
+    """
+    if keys is None:
+        return [_get_copier(e.__class__)(e, extra_args) for e in entities]
+    ret = []
+    for e, key in zip(entities, keys):
+        args = dict(extra_args, key=key)
+        ret.append(_get_copier(e.__class__)(e, args))
+    return ret
 
 
 def write_on_change(model, key, data, flush_cache=False):
@@ -154,28 +399,86 @@ def write_on_change(model, key, data, flush_cache=False):
     return obj
 
 
+def write_on_change_multi(model, key, datalist, flush_cache=False, batch_size=100):
+    """Wie `write_on_change()`, aber für viele Datensätze auf einmal.
+
+    Entities are read with one `get_multi()` per `batch_size` records, compared in memory
+    and only new or changed entities are written with `put_multi()`.
+    Returns a dict with the counts of `created`, `changed` and `unchanged` entities.
+    """
+    counts = dict(created=0, changed=0, unchanged=0)
+    is_ndb = compat.xdb_is_ndb(model)
+    for batch in _batches(datalist, batch_size):
+        keys = [compat.xdb_create_key(model, data[key]) for data in batch]
+        if is_ndb:
+            objs = ndb.get_multi(keys)
+        else:
+            objs = db.get(keys)
+        created, changed = [], []
+        for obj_key, obj, data in zip(keys, objs, batch):
+            if obj is None:
+                created.append(model(key=obj_key, **data))
+            elif _update_instance(obj, data):
+                changed.append(obj)
+        counts['created'] += len(created)
+        counts['changed'] += len(changed)
+        counts['unchanged'] += len(batch) - len(created) - len(changed)
+        if not (created or changed):
+            continue
+        if is_ndb:
+            ndb.put_multi(created + changed)
+        else:
+            db.put(created + changed)
+        if flush_cache and changed:
+            flush_ndb_cache_multi(changed)
+    return counts
+
+
+def _update_instance(obj, data):
+    """Set all values in `data` on `obj`. Returns `True` if a property was changed."""
+    if compat.xdb_is_ndb(obj):
+        declared = obj._properties
+    else:
+        declared = obj.properties()
+    names = [key for key in data if key in declared]
+    # e.g. dynamic properties of a `db.Expando`
+    others = dict((key, getattr(obj, key, None)) for key in data if key not in declared)
+    if getattr(obj, '_gaetk_snapshot', None) is not None:
+        # snapshot taken while loading, see `gaetk.changetracking`
+        before = None
+    else:
+        before = changetracking.snapshot(obj, names)
+    for key, value in data.iteritems():
+        setattr(obj, key, value)
+    if any(getattr(obj, key, None) != value for (key, value) in others.iteritems()):
+        return True
+    return bool(changetracking.changed_properties(obj, before, names=names))
+
+
 def write_on_change_instance(obj, data):
     """Schreibe Instanz mit geänderten Daten in Datastore."""
 
-    properties = compat.xdb_properties(obj)
-    dirty = False
-    for key, value in data.iteritems():
-        if value != getattr(obj, key, None):
-            setattr(obj, key, value)
-            dirty = True
+    dirty = _update_instance(obj, data)
     if dirty:
         obj.put()
 
     return dirty, obj
 
+
 def flush_ndb_cache(instance):
     """
     Flush memcached ndb instance.
 
     Especially usefull if you mix (old) db and ndb for a model.
     """
-    key = ndb.Context._memcache_prefix + compat.xdb_str_key(compat.xdb_key(instance))
-    memcache.delete(key)
+    flush_ndb_cache_multi([instance])
+
+
+def flush_ndb_cache_multi(instances):
+    """Flush memcached ndb instances (db or ndb) with a single `memcache.delete_multi()`."""
+    memcache.delete_multi(
+        [compat.xdb_str_key(compat.xdb_key(instance)) for instance in instances],
+        key_prefix=ndb.Context._memcache_prefix)
 
 
 def reload_obj(obj):
@@ -184,3 +487,28 @@ def reload_obj(obj):
         return obj.key.get(use_cache=False, use_memcache=False)
     else:
         return db.get(obj.key())
+
+
+def reload_objs(objs):
+    """Objekte ohne Cache neu laden.
+
+    `objs` may mix db and ndb instances. Uses `ndb.get_multi()` and `db.get()` with batches of keys.
+    Returns the reloaded objects in the same order, `None` for deleted ones.
+    """
+    ndb_positions, ndb_keys, db_positions, db_keys = [], [], [], []
+    for i, obj in enumerate(objs):
+        if compat.xdb_is_ndb(obj):
+            ndb_positions.append(i)
+            ndb_keys.append(obj.key)
+        else:
+            db_positions.append(i)
+            db_keys.append(obj.key())
+    ret = [None] * len(objs)
+    if ndb_keys:
+        for i, obj in zip(ndb_positions, ndb.get_multi(ndb_keys, use_cache=False, use_memcache=False)):
+            ret[i] = obj
+    if db_keys:
+        db_objs = itertools.chain.from_iterable(db.get(batch) for batch in _batches(db_keys, 500))
+        for i, obj in zip(db_positions, db_objs):
+            ret[i] = obj
+    return ret
@@ -13,6 +13,7 @@ import jinja2
 
 from jinja2.utils import Markup
 
+import gaetk.handler
 import gaetk.tools
 
 
@@ -100,10 +101,8 @@ def filter_authorize(context, value, permission_types):
 
     # Permissions disabled -> granted
     granted = context.get('request').get('_gaetk_disable_permissions', False)
-    for permission in permission_types:
-        if context.get('credential') and permission in context.get('credential').permissions:
-            granted = True
-            break
+    if not granted and context.get('credential'):
+        granted = gaetk.handler.get_permission_set(context.get('credential')).has_any(permission_types)
 
     if granted:
         value = '<span class="restricted">%s</span>' % (value)
@@ -84,11 +84,17 @@ class Session(object):
         else:
             self.__read_cookie()
 
-    @staticmethod
-    def __compute_hmac(base_key, sid, text):
+    _keyed_hmac = None  # (key, hmac object) reused for cookie reads and writes
+
+    def __compute_hmac(self, base_key, sid, text):
         """Computes the signature for text given base_key and sid."""
         key = base_key + sid
-        return b64encode(hmac.new(key, text, hashlib.sha256).digest())
+        keyed_hmac = self._keyed_hmac
+        if keyed_hmac is None or keyed_hmac[0] != key:
+            keyed_hmac = self._keyed_hmac = (key, hmac.new(key, digestmod=hashlib.sha256))
+        mac = keyed_hmac[1].copy()
+        mac.update(text)
+        return b64encode(mac.digest())
 
     def __read_cookie(self):
         """Reads the HTTP Cookie and loads the sid and data from it (if any)."""
@@ -103,7 +109,7 @@ class Session(object):
             i = SIG_LEN + SID_LEN
             sig, sid, b64pdump = data[:SIG_LEN], data[SIG_LEN:i], data[i:]
             pdump = b64decode(b64pdump)
-            actual_sig = Session.__compute_hmac(self.base_key, sid, pdump)
+            actual_sig = self.__compute_hmac(self.base_key, sid, pdump)
             if sig == actual_sig:
                 self.__set_sid(sid, False)
                 # check for expiration and terminate the session if it has expired
@@ -136,7 +142,7 @@ class Session(object):
         else:
             m = MAX_DATA_PER_COOKIE
             fmt = COOKIE_FMT
-        sig = Session.__compute_hmac(self.base_key, self.sid, self.cookie_data)
+        sig = self.__compute_hmac(self.base_key, self.sid, self.cookie_data)
         cv = sig + self.sid + b64encode(self.cookie_data)
         num_cookies = 1 + (len(cv) - 1) / m
         if self.get_expiration() > 0:
@@ -259,13 +259,23 @@ class HMACAlgorithm(SigningAlgorithm):
     #: but can be changed for any other function in the hashlib module.
     default_digest_method = staticmethod(hashlib.sha1)
 
+    #: ``(key, mac)`` - a HMAC object already initialised with the last key
+    #: used.  Copying it is much cheaper than setting up a new one.
+    _keyed_mac = None
+
     def __init__(self, digest_method=None):
         if digest_method is None:
             digest_method = self.default_digest_method
         self.digest_method = digest_method
 
     def get_signature(self, key, value):
-        mac = hmac.new(key, msg=value, digestmod=self.digest_method)
+        keyed_mac = self._keyed_mac
+        if keyed_mac is None or keyed_mac[0] != key:
+            keyed_mac = (key, hmac.new(key, digestmod=self.digest_method))
+            # replace the tuple in one step to stay thread safe
+            self._keyed_mac = keyed_mac
+        mac = keyed_mac[1].copy()
+        mac.update(value)
         return mac.digest()
 
 
@@ -304,6 +314,9 @@ class Signer(object):
     #: .. versionadded:: 0.14
     default_key_derivation = 'django-concat'
 
+    #: ``(parameters, derived_key)`` - see :meth:`derive_key`.
+    _derived_key = None
+
     def __init__(self, secret_key, salt=None, sep='.', key_derivation=None,
                  digest_method=None, algorithm=None):
         self.secret_key = want_bytes(secret_key)
@@ -325,7 +338,20 @@ class Signer(object):
         Keep in mind that the key derivation in itsdangerous is not intended
         to be used as a security method to make a complex key out of a short
         password.  Instead you should use large random secret keys.
+
+        The derived key is computed only once and reused as long as secret
+        key, salt and derivation settings stay the same.
         """
+        params = (self.secret_key, self.salt, self.key_derivation,
+                  self.digest_method)
+        derived = self._derived_key
+        if derived is None or derived[0] != params:
+            derived = (params, self._derive_key())
+            self._derived_key = derived
+        return derived[1]
+
+    def _derive_key(self):
+        """Does the actual work for :meth:`derive_key`."""
         salt = want_bytes(self.salt)
         if self.key_derivation == 'concat':
             return self.digest_method(salt + self.secret_key).digest()
@@ -521,6 +547,7 @@ class Serializer(object):
             signer = self.default_signer
         self.signer = signer
         self.signer_kwargs = signer_kwargs or {}
+        self._signers = {}
 
     def load_payload(self, payload, serializer=None):
         """Loads the encoded object.  This function raises :class:`BadPayload`
@@ -552,10 +579,20 @@ class Serializer(object):
     def make_signer(self, salt=None):
         """A method that creates a new instance of the signer to be used.
         The default implementation uses the :class:`Signer` baseclass.
+
+        Signers are kept per salt, so their derived keys are reused.
         """
         if salt is None:
             salt = self.salt
-        return self.signer(self.secret_key, salt=salt, **self.signer_kwargs)
+        cache_key = (self.secret_key, salt)
+        signer = self._signers.get(cache_key)
+        if signer is None:
+            if len(self._signers) > 32:
+                self._signers = {}
+            signer = self.signer(self.secret_key, salt=salt,
+                                 **self.signer_kwargs)
+            self._signers[cache_key] = signer
+        return signer
 
     def dumps(self, obj, salt=None):
         """Returns a signed string serialized with the internal serializer.
@@ -4,6 +4,7 @@ import threading
 import time
 
 from collections import namedtuple
+from collections import OrderedDict
 from functools import update_wrapper
 
 # from http://code.activestate.com/recipes/578078-py26-and-py30-backport-of-python-33s-lru-cache/
@@ -180,3 +181,47 @@ def lru_cache(maxsize=64, typed=False, ttl=600):
         return update_wrapper(wrapper, user_function)
 
     return decorating_function
+
+
+class TimedLRUCache(object):
+    """Small thread safe LRU cache with per entry expiry for instance local data."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the cached value for `key` or `default` if missing or expired."""
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                return default
+            # re-insert to mark as recently used
+            self._data[key] = entry
+            return entry[1]
+
+    def set(self, key, value, ttl):
+        """Cache `value` for `ttl` seconds."""
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + ttl, value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        """Remove `key` from the cache."""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_matching(self, predicate):
+        """Remove all entries where `predicate(value)` is true."""
+        with self._lock:
+            for key, (_expires, value) in self._data.items():
+                if predicate(value):
+                    del self._data[key]
+
+    def clear(self):
+        """Remove everything."""
+        with self._lock:
+            self._data.clear()
@@ -65,7 +65,7 @@ class LoginHandler(gaetk.handler.BasicHandler):
     def handle_sso(self, continue_url):
         "Try single sign on via a different hudora.de domain."
         from gaetk.lib import _itsdangerous
-        s = _itsdangerous.URLSafeTimedSerializer(self.session.base_key)
+        s = gaetk.handler.get_serializer(self.session.base_key)
         decoded_payload = None
         try:
             decoded_payload = s.loads(
@@ -458,11 +458,41 @@ class CredentialsHandler(gaetk.handler.JsonResponseHandler):
             updated_at=credential.updated_at), 201
 
 
+class TokenHandler(gaetk.handler.JsonResponseHandler):
+    """Issue bearer tokens for server-to-server calls."""
+
+    def authchecker(self, *args, **kwargs):
+        """Tokens can't be used to get fresh tokens."""
+        self.login_required()
+        if isinstance(self.credential, gaetk.handler.BearerCredential):
+            raise gaetk.handler.HTTP403_Forbidden("use your credential to request tokens")
+
+    def post(self):
+        """Use it like this
+
+            curl -u $uid:$secret -X POST -F ttl=3600 http://example.appspot.com/gaetk/auth/token
+            {
+             "token": "eyJ1aWQiOiJ1NjY2NjZvMjZlYzRiIiwiLi4uIn0.DYbF6A.pN4wM...",
+             "expires_in": 3600
+            }
+
+        and then call the API with `Authorization: Bearer $token`.
+        """
+        ttl = self.request.get_range(
+            'ttl', min_value=60, max_value=24 * 60 * 60, default=gaetk.handler.BEARER_TOKEN_TIMEOUT)
+        permissions = self.request.get('permissions', None)
+        if permissions is not None:
+            permissions = [perm for perm in permissions.split(',') if perm]
+        token = gaetk.handler.create_bearer_token(self.credential, ttl=ttl, permissions=permissions)
+        return dict(token=token, expires_in=ttl), 201, None
+
+
 # die URL-Handler fuer's Login/ Logout
 application = gaetk.webapp2.WSGIApplication([
     ('/gaetk/auth/logout', LogoutHandler),
     ('/gaetk/auth/oauth2callback', OAuth2Callback),
     ('/gaetk/auth/debug', Debug),
     ('/gaetk/auth/credentials', CredentialsHandler),
+    ('/gaetk/auth/token', TokenHandler),
     ('.*', LoginHandler),
 ], debug=False)
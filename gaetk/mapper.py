@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+gaetk/mapper.py - fan-out/fan-in jobs on top of `gaetk.infrastructure.defer`.
+
+A job splits a query into shards of `shard_size` entities (using cursors),
+runs `mapper(entity)` for every entity of a shard in its own task and calls
+`callback(job)` once all shards are finished. State is kept in the datastore.
+
+    def query_kunden(land):
+        return Kunde.query(Kunde.land == land)
+
+    def reindex(kunde):
+        kunde.put()
+        return {'reindexed': 1}
+
+    def report(job):
+        logging.info("done: %s", job.counters)
+
+    gaetk.mapper.start_job(query_kunden, reindex, query_args=('DE',), callback=report)
+
+`query_function`, `mapper` and `callback` must be module level functions
+so they can be pickled. `mapper` can return a dict of counters which are
+added up over the whole job; the number of entities processed is counted as
+`entities`. A failed shard is retried by the task queue and runs again from
+its start, so mappers should be idempotent. After `MAX_SHARD_RETRIES` the
+shard is given up and the job ends with status `failed`.
+
+Shards are root entities, so finishing them doesn't contend on the job's entity group.
+Finished shards trigger `_check_job()` at most every `JOB_CHECK_INTERVAL` seconds, which
+adds up the shard counters and ends the job once all shards are finished. If the task for
+the current window can't be added, the shard checks the job itself.
+
+Copyright (c) 2017 HUDORA. All rights reserved.
+"""
+import collections
+import logging
+
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+from gaetk.infrastructure import defer
+
+
+MAX_SHARD_RETRIES = 5
+# finished shards are checked for at most every n seconds
+JOB_CHECK_INTERVAL = 10
+
+
+class gaetk_Job(ndb.Model):
+    """State of a mapper job."""
+    name = ndb.StringProperty()
+    status = ndb.StringProperty(default='splitting', choices=['splitting', 'running', 'done', 'failed'])
+    query_function = ndb.PickleProperty()
+    query_args = ndb.PickleProperty(default=())
+    mapper = ndb.PickleProperty()
+    callback = ndb.PickleProperty()
+    queue = ndb.StringProperty(indexed=False)
+    shard_size = ndb.IntegerProperty(indexed=False)
+    shard_count = ndb.IntegerProperty(default=0, indexed=False)
+    shards_done = ndb.IntegerProperty(default=0, indexed=False)
+    shards_failed = ndb.IntegerProperty(default=0, indexed=False)
+    counters = ndb.JsonProperty(default={})
+    updated_at = ndb.DateTimeProperty(auto_now=True)
+    created_at = ndb.DateTimeProperty(auto_now_add=True)
+
+    def is_finished(self):
+        """All shards either done or failed."""
+        return self.status in ('done', 'failed')
+
+
+class gaetk_JobShard(ndb.Model):
+    """One part of a job. The id is `<job id>-<shard number>`."""
+    job = ndb.KeyProperty(kind=gaetk_Job)
+    start_cursor = ndb.StringProperty(indexed=False)
+    end_cursor = ndb.StringProperty(indexed=False)
+    status = ndb.StringProperty(default='pending', choices=['pending', 'done', 'failed'])
+    retries = ndb.IntegerProperty(default=0, indexed=False)
+    error = ndb.TextProperty()
+    counters = ndb.JsonProperty(default={})
+    updated_at = ndb.DateTimeProperty(auto_now=True)
+
+
+def start_job(query_function, mapper, query_args=(), callback=None, shard_size=500,
+              queue='workersq', name=None):
+    """Start a job running `mapper` on every entity of `query_function(*query_args)`.
+
+    Returns the key of the `gaetk_Job` entity tracking the progress.
+    """
+    job = gaetk_Job(
+        name=name or mapper.__name__, query_function=query_function, query_args=tuple(query_args),
+        mapper=mapper, callback=callback, queue=queue, shard_size=shard_size)
+    job.put()
+    defer(_split_job, job.key, _queue=queue)
+    return job.key
+
+
+def _cursor_to_str(cursor):
+    """Urlsafe representation of a cursor or `None`."""
+    if cursor is None or isinstance(cursor, basestring):
+        return cursor
+    return cursor.urlsafe()
+
+
+def _shard_boundaries(query, shard_size):
+    """Yield `(start_cursor, end_cursor)` pairs covering `query`. Only keys are read."""
+    cursor = None
+    while True:
+        if isinstance(query, ndb.Query):
+            keys, next_cursor, more = query.fetch_page(shard_size, keys_only=True, start_cursor=cursor)
+        else:
+            query.with_cursor(cursor)
+            keys = query.fetch(shard_size, keys_only=True)
+            next_cursor = query.cursor()
+            more = len(keys) == shard_size
+        if not keys:
+            break
+        if not more:
+            yield cursor, None
+            break
+        yield cursor, next_cursor
+        cursor = next_cursor
+
+
+def _shard_keys(job):
+    """Keys of all shards of `job`."""
+    return [ndb.Key(gaetk_JobShard, '%s-%d' % (job.key.id(), i)) for i in range(job.shard_count)]
+
+
+def _iterate_shard(query, start_cursor, end_cursor):
+    """Iterate over the entities of a shard."""
+    if isinstance(query, ndb.Query):
+        return query.iter(
+            start_cursor=Cursor(urlsafe=start_cursor) if start_cursor else None,
+            end_cursor=Cursor(urlsafe=end_cursor) if end_cursor else None)
+    query.with_cursor(start_cursor, end_cursor)
+    return query.run()
+
+
+def _split_job(job_key):
+    """Create a shard for each `shard_size` entities and start processing."""
+    job = job_key.get()
+    if job.status != 'splitting':
+        return  # task was retried
+    query = job.query_function(*job.query_args)
+    shards = [
+        gaetk_JobShard(id='%s-%d' % (job.key.id(), i), job=job.key,
+                       start_cursor=_cursor_to_str(start), end_cursor=_cursor_to_str(end))
+        for i, (start, end) in enumerate(_shard_boundaries(query, job.shard_size))]
+    # a retried task overwrites the same shards
+    ndb.put_multi(shards)
+    job.shard_count = len(shards)
+    job.status = 'running'
+    if not shards:
+        job.status = 'done'
+    job.put()
+    if not shards:
+        _finish_job(job)
+        return
+    logging.info("job %s: %d shards", job.name, len(shards))
+    for shard in shards:
+        defer(_run_shard, shard.key, _queue=job.queue)
+
+
+def _run_shard(shard_key):
+    """Process all entities of a shard."""
+    shard = shard_key.get()
+    if shard.status != 'pending':
+        return  # task was retried
+    job = shard.job.get()
+    counters = collections.Counter()
+    try:
+        query = job.query_function(*job.query_args)
+        for entity in _iterate_shard(query, shard.start_cursor, shard.end_cursor):
+            counters['entities'] += 1
+            counters.update(job.mapper(entity) or {})
+    except Exception as exception:
+        logging.exception("job %s shard %s failed: %s", job.name, shard_key.id(), exception)
+        shard.retries += 1
+        shard.error = unicode(exception)
+        if shard.retries < MAX_SHARD_RETRIES:
+            shard.put()
+            raise  # let the task queue retry
+        _complete_shard(job, shard_key, 'failed', counters, shard.error)
+        raise deferred.PermanentTaskFailure(exception)
+    _complete_shard(job, shard_key, 'done', counters)
+
+
+def _complete_shard(job, shard_key, status, counters, error=None):
+    """Record the shard result and check if the job is finished."""
+
+    def txn():
+        """Only the shard is written, so shards don't contend with each other."""
+        shard = shard_key.get()
+        if shard.status != 'pending':
+            return
+        shard.status = status
+        shard.counters = dict(counters)
+        shard.error = error
+        shard.put()
+
+    ndb.transaction(txn)
+    if not defer(_check_job, job.key, _queue=job.queue, _coalesce=JOB_CHECK_INTERVAL):
+        # The task for this window exists or did already run (e.g. clock skew between instances)
+        # and may not see this shard. Check now, else the last shard would leave the job running.
+        _check_job(job.key)
+
+
+def _check_job(job_key):
+    """Add up the shard results and finish the job once all shards are finished."""
+    job = job_key.get()
+    if job.is_finished():
+        return
+    shards = ndb.get_multi(_shard_keys(job))
+    if any(shard.status == 'pending' for shard in shards):
+        return
+
+    def txn():
+        """Make sure the callback is triggered only once."""
+        job = job_key.get()
+        if job.is_finished():
+            return None
+        total = collections.Counter()
+        for shard in shards:
+            total.update(shard.counters or {})
+        job.counters = dict(total)
+        job.shards_done = len([shard for shard in shards if shard.status == 'done'])
+        job.shards_failed = len(shards) - job.shards_done
+        job.status = 'failed' if job.shards_failed else 'done'
+        job.put()
+        return job
+
+    job = ndb.transaction(txn)
+    if job:
+        _finish_job(job)
+
+
+def _finish_job(job):
+    """Call the completion callback."""
+    logging.info("job %s %s: %s", job.name, job.status, job.counters)
+    if job.callback:
+        defer(job.callback, job, _queue=job.queue)
@@ -6,17 +6,35 @@ models.py
 LoggedModel is a base class for models with automatic logging.
 An AuditLog instance is created for each create, update and delete action.
 The AuditLog contains the user, ip address and timestamp.
-Furthermore, the property changes are logged as a changelist.
+Furthermore, the property changes are logged as a changelist. It is stored as
+a (compressed) JSON blob and only formatted when `AuditLog.changelist` is read.
 
 There is no support for logging of read actions yet.
 
+`LoggedModel.audit_mode` (or the `audit_mode` argument of `put()` and `delete()`)
+controls how AuditLog entries are written:
+
+* `sync` - after the entity (default)
+* `async` - in parallel to the entity
+* `transactional` - together with the entity in one transaction
+* `buffered` - collected and written with a single `db.put()` by `flush_audit_logs()`.
+  Use `AuditLogMiddleware` to flush at the end of each request.
+
+For bulk writes use `put_multi()` and `delete_multi()` instead of `db.put()` and `db.delete()`.
+
 
 Created by Christian Klein on 2011-01-22.
 Copyright (c) 2011 HUDORA. All rights reserved.
 """
+import collections
 import decimal
+import json
 import os
+import threading
+import zlib
 
+from gaetk import compat
+from gaetk.changetracking import ChangeTrackingModel
 from gaetk.lib._gaesessions import get_current_session
 from google.appengine.api import users
 from google.appengine.ext import blobstore
@@ -38,6 +56,36 @@ def get_current_user():
             return users.User(_user_id=session['uid'], email=session.get('email', ''), _strict_mode=False)
 
 
+AUDIT_MODES = ('sync', 'async', 'transactional', 'buffered')
+# buffered entries are flushed at least every AUDIT_BUFFER_SIZE entries
+AUDIT_BUFFER_SIZE = 500
+_audit_buffer = threading.local()
+# changes are compressed if their JSON encoding is longer
+AUDIT_COMPRESS_THRESHOLD = 1000
+
+
+def _encode_changes(changes):
+    """Encode a list of `(name, old, new)` or `(name, old)` tuples for `AuditLog.changes`."""
+    data = json.dumps(changes, separators=(',', ':'))
+    if len(data) > AUDIT_COMPRESS_THRESHOLD:
+        data = zlib.compress(data)
+    return data
+
+
+def _decode_changes(data):
+    """Inverse of `_encode_changes()`."""
+    if not data.startswith('['):
+        data = zlib.decompress(data)
+    return json.loads(data)
+
+
+def _format_change(change):
+    """Human readable representation of a single change."""
+    if len(change) == 2:
+        return u'%s: %s' % tuple(change)
+    return u'%s: %s \u21d2 %s' % tuple(change)
+
+
 class AuditLog(db.Model):
     """Log for a model instance"""
 
@@ -45,16 +93,82 @@ class AuditLog(db.Model):
     event = db.StringProperty(required=True, choices=set(['CREATE', 'UPDATE', 'DELETE']))
     initiator = db.UserProperty()
     ip_address = db.StringProperty()
-    changelist = db.StringListProperty()
+    changes = db.BlobProperty()
+    # entries written before `changes` was introduced
+    legacy_changelist = db.StringListProperty(name='changelist', indexed=False)
     created_at = db.DateTimeProperty(auto_now_add=True)
 
+    @property
+    def changelist(self):
+        """List of changes formatted like `u'name: old ⇒ new'`."""
+        if self.changes is None:
+            return self.legacy_changelist
+        return [_format_change(change) for change in _decode_changes(self.changes)]
+
     @classmethod
-    def create(cls, obj, event, changelist):
-        """Create an AuditLog Entry."""
+    def query_for(cls, obj, event=None, initiator=None, since=None, until=None, projection=None):
+        """AuditLog entries of `obj` (instance or key), newest first.
+
+        Uses an ancestor query, so results are strongly consistent.
+        All combinations of filters are covered by the indexes in `examples/index.yaml`.
+        """
+        query = db.Query(cls, projection=projection).ancestor(obj)
+        if event is not None:
+            query.filter('event =', event)
+        if initiator is not None:
+            query.filter('initiator =', initiator)
+        if since is not None:
+            query.filter('created_at >=', since)
+        if until is not None:
+            query.filter('created_at <', until)
+        return query.order('-created_at')
+
+    @classmethod
+    def fetch_page(cls, obj, limit=50, cursor=None, **filters):
+        """Returns `(entries, cursor, more_entries)` for `obj`.
+
+        `filters` are passed to `query_for()`. Pass the returned cursor to get the next page.
+        """
+        return compat.xdb_fetch_page(cls.query_for(obj, **filters), limit, start_cursor=cursor)
+
+    @classmethod
+    def daily_summary(cls, obj, since=None, until=None):
+        """Number of AuditLog entries per day and event, newest day first.
 
-        instance = cls(parent=obj, object=obj, event=event, changelist=changelist)
+        Returns a list of dicts like
+        `{'date': date(2017, 5, 2), 'CREATE': 0, 'UPDATE': 3, 'DELETE': 0, 'total': 3}`.
+        Only `created_at` and `event` are read (projection query).
+        """
+        days = collections.OrderedDict()
+        query = cls.query_for(obj, since=since, until=until, projection=('created_at', 'event'))
+        for entry in query.run(batch_size=1000):
+            date = entry.created_at.date()
+            if date not in days:
+                days[date] = dict(date=date, CREATE=0, UPDATE=0, DELETE=0, total=0)
+            days[date][entry.event] += 1
+            days[date]['total'] += 1
+        return days.values()
+
+    @classmethod
+    def build(cls, obj, event, changelist):
+        """Create an AuditLog Entry without writing it.
+
+        `changelist` is a list of `(name, old, new)` or `(name, old)` tuples or (old style) strings."""
+
+        instance = cls(parent=obj.key(), object=obj.key(), event=event)
+        if changelist and isinstance(changelist[0], basestring):
+            instance.legacy_changelist = changelist
+        else:
+            instance.changes = _encode_changes(changelist)
         instance.initiator = get_current_user()
         instance.ip_address = os.getenv('REMOTE_ADDR')
+        return instance
+
+    @classmethod
+    def create(cls, obj, event, changelist):
+        """Create an AuditLog Entry."""
+
+        instance = cls.build(obj, event, changelist)
         instance.put()
         return instance
 
@@ -71,83 +185,256 @@ class AuditLog(db.Model):
         return "_gaetk_AuditLog"
 
 
-class LoggedModel(db.Model):
+def _get_audit_buffer():
+    """AuditLog entries waiting to be written by this thread."""
+    if not hasattr(_audit_buffer, 'entries'):
+        _audit_buffer.entries = []
+    return _audit_buffer.entries
+
+
+def _buffer_audit_log(auditlog):
+    """Remember an AuditLog entry for `flush_audit_logs()`."""
+    entries = _get_audit_buffer()
+    entries.append(auditlog)
+    if len(entries) >= AUDIT_BUFFER_SIZE:
+        flush_audit_logs()
+
+
+def flush_audit_logs():
+    """Write all buffered AuditLog entries with a single `db.put()`."""
+    entries = _get_audit_buffer()
+    if entries:
+        db.put(entries)
+        del entries[:]
+
+
+class AuditLogMiddleware(object):
+    """WSGI middleware writing buffered AuditLog entries at the end of each request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        try:
+            return self.app(environ, start_response)
+        finally:
+            flush_audit_logs()
+
+
+def put_multi(models, audit_mode='sync', **kwargs):
+    """Write many entities with one `db.put()` and their AuditLog entries with another.
+
+    Use this instead of `db.put()` for `LoggedModel` instances. Other models are just written.
+    `audit_mode` can be `sync`, `async` or `buffered`; entities in different entity
+    groups can't be written transactionally.
+    """
+    if audit_mode not in ('sync', 'async', 'buffered'):
+        raise ValueError('unsupported audit_mode %r' % audit_mode)
+    changes = [(model, ) + model._put_changelist() for model in models if isinstance(model, LoggedModel)]
+    changes = [change for change in changes if change[2]]
+
+    rpc = None
+    if audit_mode == 'async' and all(model.has_key() for (model, _event, _changelist) in changes):
+        rpc = db.put_async([AuditLog.build(*change) for change in changes])
+    keys = db.put(models, **kwargs)
+    for model in models:
+        if isinstance(model, ChangeTrackingModel):
+            model.mark_saved()
+    if rpc:
+        rpc.get_result()
+    elif audit_mode == 'buffered':
+        for change in changes:
+            _buffer_audit_log(AuditLog.build(*change))
+    elif changes:
+        # new entities without key_name get their key only when written
+        db.put([AuditLog.build(*change) for change in changes])
+    return keys
+
+
+def delete_multi(models, audit_mode='sync', **kwargs):
+    """Delete many entities with one `db.delete()` and write their AuditLog entries with one `db.put()`."""
+    if audit_mode not in ('sync', 'async', 'buffered'):
+        raise ValueError('unsupported audit_mode %r' % audit_mode)
+    auditlogs = [AuditLog.build(model, 'DELETE', model._delete_changelist())
+                 for model in models if isinstance(model, LoggedModel)]
+    if audit_mode == 'sync' and auditlogs:
+        db.put(auditlogs)
+    elif audit_mode == 'async' and auditlogs:
+        rpc = db.put_async(auditlogs)
+    db.delete(models, **kwargs)
+    if audit_mode == 'async' and auditlogs:
+        rpc.get_result()
+    elif audit_mode == 'buffered':
+        for auditlog in auditlogs:
+            _buffer_audit_log(auditlog)
+
+
+class LoggedModel(ChangeTrackingModel):
     """Subclass of db.Model that logs all changes.
-       Does not work, if you use db.put(instance)."""
+       Use `gaetk.models.put_multi()` instead of db.put(instance)."""
 
-    def put(self, **kwargs):
+    audit_mode = 'sync'
+
+    def put(self, audit_mode=None, **kwargs):
         """Writes the model instance to the datastore and creates an AuditLog entry"""
 
+        event, changelist = self._put_changelist()
+        if not changelist:
+            return super(LoggedModel, self).put(**kwargs)
+        return self._write_audited(
+            event, changelist, audit_mode, lambda: super(LoggedModel, self).put(**kwargs))
+
+    def _put_changelist(self):
+        """Returns the event and the changelist for writing this instance."""
+
         # If the instance has not been saved yet, the related entity does not exist
-        entity = self._entity
-        if entity is None:
+        if self._entity is None:
             event = 'CREATE'
-            entity = {}
         else:
             event = 'UPDATE'
 
-        # Compare the property values with the entity values and build a changelist
+        # Only the changed properties are converted for the changelist
+        before = self._gaetk_snapshot or {}
+        changed = self.changed_properties()
         changelist = []
-        for prop in self.properties().values():
-            # see http://code.google.com/intl/de-DE/appengine/docs/python/datastore/propertyclass.html for
-            # documentation of get_value_for_datastore() and make_value_from_datastore()
-            tmp = entity.get(prop.name)
-            current_value = prop.make_value_from_datastore(tmp)
-            tmp = prop.get_value_for_datastore(self)
-            new_value = prop.make_value_from_datastore(tmp)
-
-            # Empty lists are stored as None
-            if isinstance(prop, (db.ListProperty, db.StringListProperty)):
-                if current_value is None:
-                    current_value = new_value
-            elif isinstance(prop, blobstore.BlobReferenceProperty):
+        for name, prop in self.properties().items():
+            if name not in changed:
+                continue
+            if isinstance(prop, blobstore.BlobReferenceProperty):
                 # Nice to have, but missing: Compare BlobInfo
-                current_value = new_value
-
-            if current_value != new_value:
-                if isinstance(prop, db.UnindexedProperty):
-                    # Reduce logging output to 500 chars (max length for StringProperty)
-                    if current_value and len(current_value) > 245:
-                        current_value = "%s ..." % current_value[:244]
-                    if len(new_value) > 245:
-                        new_value = "%s ..." % new_value[:244]
-                change = u'%s: %s \u21d2 %s' % (prop.name, current_value, new_value)
-                changelist.append(change[:500])
-
-        key = super(LoggedModel, self).put(**kwargs)
-        if changelist:
-            AuditLog.create(self, event, changelist)
-        return key
-
-    def delete(self, **kwargs):
+                continue
+            current_value = prop.make_value_from_datastore(before.get(name))
+            new_value = prop.make_value_from_datastore(prop.get_value_for_datastore(self))
+            if isinstance(prop, db.UnindexedProperty):
+                # Reduce logging output to 500 chars
+                if current_value and len(current_value) > 245:
+                    current_value = "%s ..." % current_value[:244]
+                if new_value and len(new_value) > 245:
+                    new_value = "%s ..." % new_value[:244]
+            changelist.append((prop.name, u'%s' % (current_value, ), u'%s' % (new_value, )))
+        return event, changelist
+
+    def delete(self, audit_mode=None, **kwargs):
         """Deletes this entity from the datastore and creates an AuditLog entry"""
+        self._write_audited('DELETE', self._delete_changelist(), audit_mode,
+                            lambda: super(LoggedModel, self).delete(**kwargs))
+
+    def _delete_changelist(self):
+        """Returns the changelist for deleting this instance."""
         entity = self._entity
         if entity is None:
             entity = {}
         changelist = []
         for prop in self.properties().values():
-            changelist.append(u'%s: %r' % (prop.name, entity.get(prop.name)))
-        AuditLog.create(self, 'DELETE', changelist)
-        super(LoggedModel, self).delete(**kwargs)
+            changelist.append((prop.name, u'%r' % (entity.get(prop.name), )))
+        return changelist
+
+    def _write_audited(self, event, changelist, audit_mode, write):
+        """Call `write()` and store an AuditLog entry according to `audit_mode`."""
+        audit_mode = audit_mode or self.audit_mode
+        if audit_mode not in AUDIT_MODES:
+            raise ValueError('unknown audit_mode %r' % audit_mode)
+
+        if audit_mode == 'transactional':
+            def txn():
+                """Entity and AuditLog are in the same entity group."""
+                ret = write()
+                AuditLog.create(self, event, changelist)
+                return ret
+            if db.is_in_transaction():
+                # part of the caller's transaction
+                return txn()
+            return db.run_in_transaction(txn)
+
+        if audit_mode == 'async' and self.has_key():
+            rpc = db.put_async(AuditLog.build(self, event, changelist))
+            ret = write()
+            rpc.get_result()
+            return ret
+
+        if event == 'DELETE' and audit_mode != 'buffered':
+            # log before deleting
+            AuditLog.create(self, event, changelist)
+            return write()
+
+        # new entities without key_name get their key only when written
+        ret = write()
+        if audit_mode == 'buffered':
+            _buffer_audit_log(AuditLog.build(self, event, changelist))
+        else:
+            AuditLog.create(self, event, changelist)
+        return ret
 
     @property
-    def logentries(self, event=None):
-        """Retrieve all logentries for the current object"""
+    def logentries(self):
+        """Retrieve all logentries for the current object
 
-        if not self.is_saved:
+        Better use `get_logentries()` which can filter and paginate."""
+
+        if not self.is_saved():
             return []
+        return AuditLog.query_for(self)
 
-        queryset = AuditLog.all().filter('object =', self)
-        if event is not None:
-            queryset.filter('event =', event)
-        return queryset
+    def get_logentries(self, limit=50, cursor=None, **filters):
+        """Returns `(entries, cursor, more_entries)`, see `AuditLog.fetch_page()`."""
+
+        if not self.is_saved():
+            return [], None, False
+        return AuditLog.fetch_page(self, limit, cursor, **filters)
+
+
+# fast construction of Decimals, not available with cdecimal
+_dec_from_triple = getattr(decimal, '_dec_from_triple', None)
+
+
+def decimals_to_scaled(values, precision):
+    """Convert Decimals to integers scaled by `10 ** precision`, rounded half up. `None` stays `None`."""
+    quantum = decimal.Decimal(1).scaleb(-precision)
+    rounding = decimal.ROUND_HALF_UP
+    if _dec_from_triple is None:
+        return [None if value is None else int(value.quantize(quantum, rounding=rounding).scaleb(precision))
+                for value in values]
+    # use the coefficient directly, most values already have the right number of decimal places
+    exponent = -precision
+    ret = []
+    for value in values:
+        if value is None:
+            ret.append(None)
+            continue
+        if value._exp != exponent:
+            value = value.quantize(quantum, rounding=rounding)
+        ret.append(-int(value._int) if value._sign else int(value._int))
+    return ret
+
+
+def scaled_to_decimals(values, precision):
+    """Convert integers scaled by `10 ** precision` to Decimals. `None` stays `None`.
+
+    Much cheaper than parsing strings, e.g. for raw entities from `datastore.Query` or projection queries.
+    """
+    if _dec_from_triple is None:
+        return [None if value is None else decimal.Decimal(value).scaleb(-precision) for value in values]
+    exponent = -precision
+    return [None if value is None else _dec_from_triple(int(value < 0), str(abs(value)), exponent)
+            for value in values]
 
 
 class DecimalProperty(db.Property):
-    """A decimal property"""
+    """A decimal property
+
+    Values are stored as strings. With `precision=n` they are stored as integers scaled
+    by `10 ** n` instead (e.g. cents for `precision=2`). This is much faster to convert
+    and sorts numerically. Values with more decimal places are rounded half up.
+    Strings written without `precision` can still be read.
+    """
 
     data_type = decimal.Decimal
 
+    def __init__(self, *args, **kwargs):
+        # keyword only, the positional arguments are those of `db.Property`
+        self.precision = kwargs.pop('precision', None)
+        super(DecimalProperty, self).__init__(*args, **kwargs)
+
     def validate(self, value):
         """Validate decimal property.
 
@@ -189,6 +476,8 @@ class DecimalProperty(db.Property):
         tmp = super(DecimalProperty, self).get_value_for_datastore(model_instance)
         if tmp is None:
             return None
+        if self.precision is not None:
+            return decimals_to_scaled([tmp], self.precision)[0]
         return str(tmp)
 
     def make_value_from_datastore(self, value):
@@ -199,4 +488,27 @@ class DecimalProperty(db.Property):
         """
         if value is None:
             return value
+        if self.precision is not None and not isinstance(value, basestring):
+            return scaled_to_decimals([value], self.precision)[0]
         return self.data_type(value)
+
+
+def decimal_columns(model_class, entities):
+    """Read the `DecimalProperty` values of raw entities column by column.
+
+    `entities` are `datastore.Entity` objects (or other mappings like projection results) of
+    `model_class`. Returns `{property name: [Decimal or None, ...]}` in the order of `entities`.
+    Scaled integers are converted in one batch per property, so e.g. sums over many entities
+    don't need model instances.
+    """
+    ret = {}
+    for name, prop in model_class.properties().iteritems():
+        if not isinstance(prop, DecimalProperty):
+            continue
+        values = [entity.get(prop.name) for entity in entities]
+        if prop.precision is not None and not any(isinstance(value, basestring) for value in values):
+            ret[name] = scaled_to_decimals(values, prop.precision)
+        else:
+            # strings written before `precision` was set
+            ret[name] = [prop.make_value_from_datastore(value) for value in values]
+    return ret
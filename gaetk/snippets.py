@@ -2,29 +2,77 @@
 # encoding: utf-8
 """snippets.py - editable parts of webpages.
 
+Compiled snippets are cached in the instance, keyed by the hash of their markdown.
+Rendered snippets which don't use any template variables (globals included) or context
+filters are cached in memcache together with the version of the snippet.
+`invalidate_snippet()` changes the version, so renderings started before an edit are
+never shown afterwards.
+
+The snippets used by a template are recorded while rendering it. The next time
+the template is rendered, all of them are loaded with one `memcache.get_multi()`
+and one `ndb.get_multi()` when the first snippet is shown.
+
+Rendering never writes to the datastore or the task queue. The pages where snippets
+are shown are counted in the instance and stored by a deferred task every
+`SNIPPET_USAGE_FLUSH_INTERVAL` seconds, see `gaetk_SnippetUsage`. The task is added
+by `SnippetUsageMiddleware` while the next request is handled:
+
+    def webapp_add_wsgi_middleware(app):
+        return gaetk.snippets.SnippetUsageMiddleware(app)
+
+Counts of an instance which is shut down before its next request are lost.
+
 Created by Maximillian Dornseif on 2014-11-22.
 Copyright (c) 2014, 2017 HUDORA. All rights reserved.
 """
 
 import cgi
+import collections
+import hashlib
 import logging
 import os
-import random
+import threading
+import time
 
 import jinja2
+import jinja2.meta
+import jinja2.nodes
 
 import gaetk
 import gaetk.defaulthandlers
 import gaetk.handler
+import gaetk.infrastructure
 import gaetk.jinja_filters
+import gaetk.lib._lru_cache
 import gaetk.tools
 import huTools.http.tools
 
 from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.api import users
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
 
 
+SNIPPET_CACHE_TIMEOUT = 60 * 60 * 24
+SNIPPET_TEMPLATE_CACHE_SIZE = 200
+# (environment, sha1(markdown)) -> (template, uses_context)
+_template_cache = gaetk.lib._lru_cache.TimedLRUCache(SNIPPET_TEMPLATE_CACHE_SIZE)
+# template name -> frozenset of the snippet names shown by it
+_template_snippets = {}
+SNIPPET_USAGE_FLUSH_INTERVAL = 60
+# paths kept per snippet in `gaetk_SnippetUsage`
+SNIPPET_USAGE_MAX_PATHS = 20
+SNIPPET_USAGE_QUEUE = 'workersq'
+SNIPPET_USAGE_URL = '/_ah/queue/deferred/_store_usage'
+# (db_name, path_info) -> number of times shown since the last flush
+_usage = collections.Counter()
+# db_name -> default markdown of snippets not in the datastore yet
+_usage_defaults = {}
+_usage_lock = threading.Lock()
+_usage_flushed_at = [time.time()]
+
+
 class gaetk_Snippet(ndb.Model):
     """Encodes a small pice of text for a jinja2 template."""
     name = ndb.StringProperty()
@@ -34,6 +82,14 @@ class gaetk_Snippet(ndb.Model):
     created_at = ndb.DateTimeProperty(auto_now_add=True)
 
 
+class gaetk_SnippetUsage(ndb.Model):
+    """How often a snippet was shown and where. The id is the name of the snippet."""
+    count = ndb.IntegerProperty(default=0)
+    # path_info -> count for the most used paths
+    paths = ndb.JsonProperty(default={})
+    updated_at = ndb.DateTimeProperty(auto_now=True)
+
+
 @jinja2.contextfunction
 def show_snippet(ctx, name, default=''):
     """Render a snippet inside a jinja2 template."""
@@ -63,31 +119,29 @@ def show_snippet(ctx, name, default=''):
         </script>
     '''.format(name=name, css_name=css_name, url_name=url_name, path_info=path_info)
 
-    content = memcache.get('gaetk_snippet2:%s:rendered' % db_name)
-    if random.random() < 0.01 or content is None:
-        snippet = gaetk_Snippet.get_by_id(db_name)
+    prefetched = _get_prefetched(ctx, db_name)
+    content, snippet, version = prefetched[db_name]
+    _record_usage(db_name, path_info, default if content is None and not snippet else None)
+    if content is None:
         if not snippet:
-            logging.info("generating snippet %s", db_name)
             snippet = gaetk_Snippet(id=db_name, name=db_name, markdown=default)
 
-        if snippet.path_info is None or not path_info.startswith(snippet.path_info.encode('utf-8', 'ignore')):
-            # with 1% chance we overwrite the existing path
-            if not snippet.path_info or random.random() < 0.01:
-                snippet.path_info = path_info
-                snippet.put()
-
         # generate snippet
-        if content is None:
-            try:
-                content = render(name, ctx, snippet.markdown)
-            except Exception as exception:
-                # TODO: raise in raven
-                logging.info('ctx = %s', ctx.vars)
-                logging.info('exported = %s', ctx.get_exported())
-                logging.info('env = %s', vars(env))
-                logging.exception(u'Fehler beim Rendern des Snippet %s: %s', snippet.key.id(), exception)
-                ret = u'Fehler!<!-- Rendering error: %s -->%s' % (cgi.escape(str(exception)), edit)
-                return jinja2.Markup(ret)
+        try:
+            template, uses_context = _compile(env, snippet.markdown)
+            content = template.render(dict(ctx.items()))
+        except Exception as exception:
+            # TODO: raise in raven
+            logging.info('ctx = %s', ctx.vars)
+            logging.info('exported = %s', ctx.get_exported())
+            logging.info('env = %s', vars(env))
+            logging.exception(u'Fehler beim Rendern des Snippet %s: %s', snippet.key.id(), exception)
+            ret = u'Fehler!<!-- Rendering error: %s -->%s' % (cgi.escape(str(exception)), edit)
+            return jinja2.Markup(ret)
+        prefetched[db_name] = (None if uses_context else content, snippet, version)
+        if not uses_context and version is not None:
+            if not memcache.set(_rendered_cache_key(db_name), (version, content), SNIPPET_CACHE_TIMEOUT):
+                logging.error('Memcache set failed.')
 
     assert content is not None
     return jinja2.Markup(u'''<div
@@ -99,14 +153,201 @@ def show_snippet(ctx, name, default=''):
             css_name=css_name, name=name, edit=edit, content=content))
 
 
+def _get_prefetched(ctx, db_name):
+    """Return the snippets loaded for the template rendered in `ctx`, including `db_name`.
+
+    On the first call for `ctx` all snippets recorded for the template are loaded at once.
+    """
+    if ctx.name:
+        known = _template_snippets.get(ctx.name, frozenset())
+        if db_name not in known:
+            # replaced instead of changed, so other threads can iterate safely
+            _template_snippets[ctx.name] = known | frozenset([db_name])
+    else:
+        known = frozenset()
+    prefetched = getattr(ctx, '_gaetk_snippets', None)
+    if prefetched is None:
+        prefetched = ctx._gaetk_snippets = {}
+    if db_name not in prefetched:
+        prefetched.update(prefetch_snippets((known | frozenset([db_name])) - set(prefetched)))
+    return prefetched
+
+
+def prefetch_snippets(db_names):
+    """Load the given snippets with one call to memcache and one to the datastore.
+
+    Returns a dict of `db_name -> (rendered content, gaetk_Snippet, version)`. Snippets found in
+    memcache are not loaded from the datastore, for snippets not found at all content and snippet
+    are `None`. Content rendered from the snippet may be cached under `version`, unless it is `None`.
+    """
+    db_names = list(db_names)
+    cached = memcache.get_multi(
+        [_rendered_cache_key(db_name) for db_name in db_names]
+        + [_version_cache_key(db_name) for db_name in db_names])
+    versions = dict((db_name, cached.get(_version_cache_key(db_name))) for db_name in db_names)
+    unversioned = [db_name for (db_name, version) in versions.items() if version is None]
+    if unversioned:
+        # start with a number never used before, see `invalidate_snippet()`
+        new = dict((_version_cache_key(db_name), int(time.time() * 1000)) for db_name in unversioned)
+        # someone else was faster: don't cache with an unknown version
+        failed = set(memcache.add_multi(new))
+        for db_name in unversioned:
+            if _version_cache_key(db_name) not in failed:
+                versions[db_name] = new[_version_cache_key(db_name)]
+
+    ret = {}
+    missing = []
+    for db_name in db_names:
+        version = versions[db_name]
+        rendered = cached.get(_rendered_cache_key(db_name))
+        if version is not None and rendered is not None and rendered[0] == version:
+            ret[db_name] = (rendered[1], None, version)
+        else:
+            missing.append(db_name)
+            ret[db_name] = (None, None, version)
+    if missing:
+        snippets = ndb.get_multi([ndb.Key(gaetk_Snippet, db_name) for db_name in missing])
+        for db_name, snippet in zip(missing, snippets):
+            ret[db_name] = (None, snippet, versions[db_name])
+    return ret
+
+
+def _record_usage(db_name, path_info, default=None):
+    """Count that `db_name` was shown on `path_info`. `default` is given for new snippets."""
+    with _usage_lock:
+        _usage[(db_name, path_info)] += 1
+        if default is not None:
+            _usage_defaults[db_name] = default
+
+
+def flush_snippet_usage(force=False):
+    """Start storing the usage counted in this instance with a deferred task.
+
+    Does nothing until `SNIPPET_USAGE_FLUSH_INTERVAL` seconds have passed, unless `force` is set
+    or new snippets are waiting to be created. Returns the RPC adding the task or `None`.
+    """
+    with _usage_lock:
+        due = force or _usage_defaults or time.time() > _usage_flushed_at[0] + SNIPPET_USAGE_FLUSH_INTERVAL
+        if not due or not _usage:
+            return None
+        counts = dict(_usage)
+        defaults = dict(_usage_defaults)
+        _usage.clear()
+        _usage_defaults.clear()
+        _usage_flushed_at[0] = time.time()
+    payload = deferred.serialize(_store_usage, counts, defaults)
+    if len(payload) > gaetk.infrastructure.TASK_PAYLOAD_LIMIT:
+        # rare, `defer()` moves the payload to the datastore
+        gaetk.infrastructure.defer(_store_usage, counts, defaults, _queue=SNIPPET_USAGE_QUEUE)
+        return None
+    task = taskqueue.Task(url=SNIPPET_USAGE_URL, payload=payload,
+                          headers={'Content-Type': 'application/octet-stream'})
+    return taskqueue.Queue(SNIPPET_USAGE_QUEUE).add_async(task)
+
+
+class SnippetUsageMiddleware(object):
+    """WSGI middleware storing the snippet usage of earlier requests while handling a request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        try:
+            rpc = flush_snippet_usage()
+        except Exception as exception:
+            # statistics are not worth failing the page for
+            logging.warn(u'Snippet usage lost: %s', exception)
+            rpc = None
+        try:
+            return self.app(environ, start_response)
+        finally:
+            if rpc:
+                try:
+                    rpc.get_result()
+                except Exception as exception:
+                    logging.warn(u'Snippet usage lost: %s', exception)
+
+
+def _store_usage(counts, defaults):
+    """Deferred: add `counts` to `gaetk_SnippetUsage` and create snippets shown for the first time."""
+    usage = collections.defaultdict(collections.Counter)
+    for (db_name, path_info), count in counts.items():
+        usage[db_name][path_info] += count
+    for db_name, paths in usage.items():
+        _store_snippet_usage(db_name, paths, defaults.get(db_name))
+
+
+@ndb.transactional(xg=True)
+def _store_snippet_usage(db_name, paths, default):
+    """Add `paths` to the usage of `db_name`, `path_info` of the snippet is set to the most used path."""
+    stats = gaetk_SnippetUsage.get_by_id(db_name) or gaetk_SnippetUsage(id=db_name)
+    merged = collections.Counter(stats.paths or {})
+    merged.update(paths)
+    stats.count += sum(paths.values())
+    stats.paths = dict(merged.most_common(SNIPPET_USAGE_MAX_PATHS))
+    snippet = gaetk_Snippet.get_by_id(db_name)
+    if not snippet and default is not None:
+        logging.info("generating snippet %s", db_name)
+        snippet = gaetk_Snippet(id=db_name, name=db_name, markdown=default)
+    if snippet and not snippet.path_info:
+        snippet.path_info = merged.most_common(1)[0][0]
+        ndb.put_multi([stats, snippet])
+    else:
+        stats.put()
+
+
+def get_snippet_usage(db_names=None):
+    """Return a dict `db_name -> gaetk_SnippetUsage` for the given (or all) snippets."""
+    if db_names is None:
+        return dict((stats.key.id(), stats) for stats in gaetk_SnippetUsage.query())
+    stats = ndb.get_multi([ndb.Key(gaetk_SnippetUsage, db_name) for db_name in db_names])
+    return dict((db_name, obj) for (db_name, obj) in zip(db_names, stats) if obj)
+
+
+def _rendered_cache_key(db_name):
+    """Memcache key for `(version, rendered content)` of the snippet `db_name`."""
+    return 'gaetk_snippet4:%s:rendered' % db_name
+
+
+def _version_cache_key(db_name):
+    """Memcache key for the version of the snippet `db_name`."""
+    return 'gaetk_snippet4:%s:version' % db_name
+
+
+def _compile(env, markdown):
+    """Return the compiled template for `markdown` and whether it depends on the context.
+
+    Only templates without any variables render the same everywhere, so the result can be cached.
+    Globals count as variables: handlers change them for every request. So do context filters
+    like `authorize` which read e.g. the credential from the context.
+    """
+    cachekey = (env, hashlib.sha1((markdown or u'').encode('utf-8')).hexdigest())
+    cached = _template_cache.get(cachekey)
+    if cached is None:
+        import huTools.markdown2
+        source = huTools.markdown2.markdown(markdown or u'')
+        ast = env.parse(source)
+        uses_context = bool(jinja2.meta.find_undeclared_variables(ast)) or any(
+            getattr(env.filters.get(node.name), 'contextfilter', False)
+            for node in ast.find_all(jinja2.nodes.Filter))
+        cached = (env.from_string(source), uses_context)
+        _template_cache.set(cachekey, cached, SNIPPET_CACHE_TIMEOUT)
+    return cached
+
+
 def render(name, ctx, markdown):
-    """Snippet mit Jinja2 rendern und in memcache speichern"""
-    import huTools.markdown2
-    template = ctx.environment.from_string(huTools.markdown2.markdown(markdown))
-    content = template.render(dict(ctx.items()))
-    if not memcache.set('gaetk_snippet2:%s:rendered' % name, content, 600):
-        logging.error('Memcache set failed.')
-    return content
+    """Snippet mit Jinja2 rendern"""
+    template, _uses_context = _compile(ctx.environment, markdown)
+    return template.render(dict(ctx.items()))
+
+
+def invalidate_snippet(name):
+    """Make the rendered snippet in memcache invalid, e.g. after editing it.
+
+    Changes the version instead of deleting the content, so a rendering which loaded the
+    snippet before the edit can't store the old content again.
+    """
+    memcache.incr(_version_cache_key(name), initial_value=int(time.time() * 1000))
 
 
 class SnippetEditHandler(gaetk.handler.BasicHandler):
@@ -133,7 +374,7 @@ class SnippetEditHandler(gaetk.handler.BasicHandler):
         markdown = self.request.get('sniptext', u'')
         continue_url = self.request.get('continue_url', '')
         try:
-            render(name, self.create_jinja2env(), markdown)
+            _compile(self.create_jinja2env(), markdown)
         except Exception as exception:
             logging.exception(u'Fehler beim Rendern des Snippet: %s', exception)
             self.add_message('error', u'Fehler: %s' % exception)
@@ -142,6 +383,7 @@ class SnippetEditHandler(gaetk.handler.BasicHandler):
         snippet = gaetk_Snippet.get_or_insert(name, name=name, path_info='')
         snippet.markdown = markdown
         snippet.put()
+        invalidate_snippet(name)
 
         if continue_url:
             location = continue_url
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+changetracking_test.py
+
+Tests for gaetk.changetracking
+
+Copyright (c) 2017 HUDORA GmbH. All rights reserved.
+"""
+import datetime
+import unittest
+
+from gaetk import changetracking
+
+from google.appengine.ext import db
+from google.appengine.ext import ndb
+
+
+class NdbTracked(changetracking.NdbChangeTrackingModel):
+    name = ndb.StringProperty()
+    tags = ndb.StringProperty(repeated=True)
+    day = ndb.DateProperty()
+    updated_at = ndb.DateTimeProperty(auto_now=True)
+
+
+class DbTracked(changetracking.ChangeTrackingModel):
+    name = db.StringProperty()
+    tags = db.StringListProperty()
+    day = db.DateProperty()
+    updated_at = db.DateTimeProperty(auto_now=True)
+    created_at = db.DateTimeProperty(auto_now_add=True)
+
+
+class NdbUntracked(ndb.Model):
+    name = ndb.StringProperty()
+
+
+class TestChangeTracking(unittest.TestCase):
+
+    def _check(self, model, get):
+        """helper: changes are noticed after loading and saving"""
+        instance = model(name=u'Name', day=datetime.date(2017, 5, 1))
+        self.assertEquals(instance.changed_properties(), set(['name', 'day']))
+        instance.put()
+        self.assertEquals(instance.changed_properties(), set())
+        instance = get(instance)
+        self.assertEquals(instance.changed_properties(), set())
+        instance.name = u'Name'
+        instance.tags = []
+        self.assertEquals(instance.changed_properties(), set())
+        instance.tags.append(u'neu')
+        instance.day = datetime.date(2017, 5, 2)
+        self.assertEquals(instance.changed_properties(), set(['tags', 'day']))
+
+    def test_ndb(self):
+        self._check(NdbTracked, lambda instance: instance.key.get(use_cache=False, use_memcache=False))
+
+    def test_db(self):
+        self._check(DbTracked, lambda instance: db.get(instance.key()))
+
+    def test_explicit_snapshot(self):
+        instance = NdbUntracked(name=u'Name')
+        before = changetracking.snapshot(instance)
+        instance.name = u'Name'
+        self.assertEquals(changetracking.changed_properties(instance, before), set())
+        instance.name = u'Neu'
+        self.assertEquals(changetracking.changed_properties(instance, before), set(['name']))
+
+
+if __name__ == '__main__':
+    unittest.main()
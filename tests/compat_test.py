@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+compat_test.py
+
+Tests for gaetk.compat
+
+Copyright (c) 2017 HUDORA GmbH. All rights reserved.
+"""
+import unittest
+
+from gaetk import compat
+
+from google.appengine.ext import db
+from google.appengine.ext import ndb
+
+
+class NdbKunde(ndb.Model):
+    name = ndb.StringProperty()
+
+
+class DbKunde(db.Model):
+    name = db.StringProperty()
+
+
+class TestAdapter(unittest.TestCase):
+    """The cached adapter gives the same answers as the old type checks."""
+
+    def test_adapter(self):
+        for model, key in [(NdbKunde, ndb.Key('NdbKunde', 'x')), (DbKunde, db.Key.from_path('DbKunde', 'x'))]:
+            obj = model(key=key, name='x')
+            adapter = compat.xdb_adapter(obj)
+            self.assertTrue(adapter is compat.xdb_adapter(model))
+            self.assertEquals(adapter.kind, model.__name__)
+            self.assertEquals(adapter.key(obj), key)
+            self.assertEquals(adapter.id(obj), 'x')
+            self.assertEquals(adapter.create_key('x'), key)
+            self.assertEquals(adapter.property_names, ['name'])
+            self.assertEquals(compat.xdb_is_ndb(obj), model is NdbKunde)
+
+
+class TestAsync(unittest.TestCase):
+    """Mixed db and ndb lookups via futures."""
+
+    def setUp(self):
+        NdbKunde(id='1', name='ndb').put()
+        DbKunde(key_name='2', name='db').put()
+
+    def test_gather(self):
+        results = compat.gather(
+            compat.get_by_id_or_name_async(NdbKunde, '1'),
+            compat.get_by_id_or_name_async(DbKunde, '2'),
+            compat.xdb_get_async(ndb.Key(NdbKunde, '1')),
+            compat.xdb_get_async(db.Key.from_path('DbKunde', '2')),
+            compat.get_by_id_or_name_async(DbKunde, 'missing'))
+        self.assertEquals([obj and obj.name for obj in results], ['ndb', 'db', 'ndb', 'db', None])
+
+    def test_parent(self):
+        """Parents can be given as keys or instances."""
+        parent = DbKunde.get_by_key_name('2')
+        DbKunde(key_name='child', parent=parent, name='child').put()
+        ndb_parent = NdbKunde.get_by_id('1')
+        NdbKunde(id='child', parent=ndb_parent.key, name='ndb child').put()
+        results = compat.gather(
+            compat.get_by_id_or_name_async(DbKunde, 'child', parent=parent),
+            compat.get_by_id_or_name_async(DbKunde, 'child', parent=parent.key()),
+            compat.get_by_id_or_name_async(NdbKunde, 'child', parent=ndb_parent))
+        self.assertEquals([obj and obj.name for obj in results], ['child', 'child', 'ndb child'])
+        self.assertEquals(compat.get_by_id_or_name(DbKunde, 'child', parent=parent).name, 'child')
+
+    def test_queries(self):
+        ndb_page, db_page, ndb_all, db_all = compat.gather(
+            compat.xdb_fetch_page_async(NdbKunde.query(), 10),
+            compat.xdb_fetch_page_async(DbKunde.all(), 10),
+            compat.xdb_query_run_async(NdbKunde.query()),
+            compat.xdb_query_run_async(DbKunde.all()))
+        self.assertEquals([obj.name for obj in ndb_page[0]], ['ndb'])
+        self.assertEquals([obj.name for obj in db_page[0]], ['db'])
+        self.assertEquals(ndb_page[2], False)
+        self.assertEquals([obj.name for obj in ndb_all + db_all], ['ndb', 'db'])
+
+    def tearDown(self):
+        ndb.delete_multi(NdbKunde.query().fetch(keys_only=True))
+        db.delete(DbKunde.all(keys_only=True).fetch(100))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+configuration_test.py
+
+Tests for the caching in gaetk.configuration
+
+Copyright (c) 2017 HUDORA GmbH. All rights reserved.
+"""
+import unittest
+
+from gaetk import configuration
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+
+class TestConfigCache(unittest.TestCase):
+
+    def setUp(self):
+        memcache.flush_all()
+        configuration._config_cache.clear()
+        configuration._snapshot_cache.clear()
+        ndb.delete_multi(configuration.gaetk_Configuration.query().fetch(keys_only=True))
+
+    def test_cached(self):
+        """Values end up in the instance cache and in memcache."""
+        configuration.set_config('FLAG', True)
+        self.assertEqual(configuration.get_config('FLAG'), True)
+        generation = configuration._get_generation()
+        self.assertEqual(configuration._config_cache.get((generation, 'FLAG')), 'true')
+        self.assertEqual(memcache.get('gaetk_config:%s:FLAG' % generation), 'true')
+        configuration._config_cache.clear()
+        self.assertEqual(configuration.get_config_multi(['FLAG']), {'FLAG': 'true'})
+
+    def test_invalidation(self):
+        """Writes are visible immediately, also for get_config_multi()."""
+        configuration.set_config('A', 1)
+        self.assertEqual(configuration.get_config_multi(['A', 'B']), {'A': '1'})
+        generation = memcache.get(configuration._CONFIG_GENERATION_KEY)
+        configuration.set_config('B', 2)
+        self.assertEqual(memcache.get(configuration._CONFIG_GENERATION_KEY), generation + 1)
+        self.assertEqual(configuration.get_config_multi(['A', 'B']), {'A': '1', 'B': '2'})
+        configuration.set_config('A', 3)
+        self.assertEqual(configuration.get_config('A'), 3)
+
+    def test_default(self):
+        """Missing keys return the default without a write."""
+        generation = configuration._get_generation()
+        self.assertEqual(configuration.get_config('NEW', default=5), 5)
+        self.assertEqual(configuration.gaetk_Configuration.get_by_id('NEW'), None)
+        self.assertEqual(configuration._get_generation(), generation)
+        self.assertEqual(configuration._config_cache.get((generation, 'NEW')), configuration._CONFIG_MISSING)
+        self.assertEqual(configuration.get_config('NEW', default=6), 6)
+        configuration.set_config('NEW', 7)
+        self.assertEqual(configuration.get_config('NEW', default=6), 7)
+
+    def test_snapshot(self):
+        """Snapshots are shared until the configuration changes."""
+        configuration.set_config('A', 1)
+        configuration.set_config('B', [u'x'])
+        snapshot = configuration.get_config_snapshot()
+        self.assertEqual(dict(snapshot), {'A': 1, 'B': (u'x',)})
+        self.assertTrue(configuration.get_config_snapshot() is snapshot)
+        self.assertEqual(dict(configuration.get_config_snapshot(['A', 'C'])), {'A': 1})
+        with self.assertRaises(TypeError):
+            snapshot['A'] = 2
+        configuration.set_config('A', 2)
+        self.assertEqual(configuration.get_config_snapshot()['A'], 2)
+
+    def test_snapshot_frozen(self):
+        """Shared snapshots can't be changed through nested values."""
+        configuration.set_config('C', {'a': [1, {'b': [2]}]})
+        snapshot = configuration.get_config_snapshot()
+        value = snapshot['C']
+        self.assertEqual(value, {'a': (1, {'b': (2,)})})
+        with self.assertRaises(TypeError):
+            value['a'] = 2
+        with self.assertRaises(TypeError):
+            value['a'][1]['b'] = 3
+        self.assertRaises(AttributeError, getattr, value['a'], 'append')
+        self.assertEqual(configuration.get_config('C'), {'a': [1, {'b': [2]}]})
+
+
+if __name__ == '__main__':
+    unittest.main()
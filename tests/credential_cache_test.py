@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+credential_cache_test.py
+
+Tests for the credential and HTTP-Basic-Auth caches in gaetk.handler
+
+Copyright (c) 2017 HUDORA GmbH. All rights reserved.
+"""
+import base64
+import unittest
+
+import gaetk
+import webtest
+
+from google.appengine.api import memcache
+from huTools.hujson2 import loads
+
+from gaetk.gaesessions import SessionMiddleware
+
+
+class AuthHandler(gaetk.handler.JsonResponseHandler):
+    def authchecker(self, *args, **kwargs):
+        self.login_required()
+
+    def get(self):
+        return {'uid': self.credential.uid}
+
+
+class TestCredentialLookup(unittest.TestCase):
+    """`_get_credential()` reads the datastore only once per uid."""
+
+    def setUp(self):
+        memcache.flush_all()
+        gaetk.handler._credential_cache.clear()
+        self.credential = gaetk.handler.NdbCredential.create(uid='apiuser', text='test')
+        memcache.flush_all()
+        gaetk.handler._credential_cache.clear()
+
+    def test_tiers(self):
+        """Credentials are cached in the instance and in memcache."""
+        self.assertEquals(gaetk.handler._get_credential('apiuser').uid, 'apiuser')
+        self.assertEquals(memcache.get(gaetk.handler._credential_memcache_key('apiuser')).uid, 'apiuser')
+        # a new instance finds the credential in memcache
+        gaetk.handler._credential_cache.clear()
+        self.credential.key.delete(use_cache=False)
+        memcache.set(gaetk.handler._credential_memcache_key('apiuser'), self.credential)
+        self.assertEquals(gaetk.handler._get_credential('apiuser').uid, 'apiuser')
+        self.assertEquals(gaetk.handler._credential_cache.get('apiuser').uid, 'apiuser')
+
+    def test_negative(self):
+        """Unknown uids are remembered in both tiers."""
+        self.assertEquals(gaetk.handler._get_credential('unknown'), None)
+        self.assertEquals(memcache.get(gaetk.handler._credential_memcache_key('unknown')),
+                          gaetk.handler._CREDENTIAL_MISSING)
+        self.assertEquals(gaetk.handler._credential_cache.get('unknown'), gaetk.handler._CREDENTIAL_MISSING)
+
+    def test_invalidation(self):
+        """Writing or deleting a credential drops the cached copies."""
+        gaetk.handler._get_credential('apiuser')
+        self.credential.text = 'changed'
+        self.credential.put()
+        self.assertEquals(gaetk.handler._credential_cache.get('apiuser'), None)
+        self.assertEquals(memcache.get(gaetk.handler._credential_memcache_key('apiuser')), None)
+        self.assertEquals(gaetk.handler._get_credential('apiuser').text, 'changed')
+        self.credential.key.delete()
+        self.assertEquals(gaetk.handler._get_credential('apiuser'), None)
+
+    def tearDown(self):
+        """Remove all credentials"""
+        for key in gaetk.handler.NdbCredential.query().iter(keys_only=True):
+            key.delete()
+
+
+class TestCredentialCache(unittest.TestCase):
+    """Cached authentication must never outlive a changed or revoked secret."""
+
+    def setUp(self):
+        memcache.flush_all()
+        gaetk.handler._credential_cache.clear()
+        gaetk.handler._basic_auth_cache.clear()
+        self.credential = gaetk.handler.NdbCredential.create(uid='apiuser', text='test')
+
+        wsgiapp = gaetk.webapp2.WSGIApplication([(r'/', AuthHandler)])
+        wsgiapp = SessionMiddleware(wsgiapp, cookie_key='this should be a 32 character key')
+        self.app = webtest.TestApp(wsgiapp)
+
+    def _get(self, uid, secret, status=200):
+        """helper: requests `/` via HTTP-Basic-Auth without session cookies"""
+        self.app.reset()
+        headers = {'Authorization': 'Basic %s' % base64.b64encode('%s:%s' % (uid, secret)),
+                   'Accept': 'application/json'}
+        return self.app.get('/', headers=headers, status=status)
+
+    def test_basic_auth(self):
+        """Repeated requests are served from the cache."""
+        response = self._get('apiuser', self.credential.secret)
+        self.assertEquals(loads(response.body), {'uid': 'apiuser'})
+        response = self._get('apiuser', self.credential.secret)
+        self.assertEquals(loads(response.body), {'uid': 'apiuser'})
+        self._get('apiuser', 'wrong', status=401)
+
+    def test_unknown_uid(self):
+        """Unknown uids are cached negatively but show up once created."""
+        self._get('newuser', 'secret', status=401)
+        self.assertEquals(gaetk.handler._get_credential('newuser'), None)
+        credential = gaetk.handler.NdbCredential.create(uid='newuser')
+        self._get('newuser', credential.secret)
+
+    def test_changed_secret(self):
+        """After changing the secret only the new one is accepted."""
+        oldsecret = self.credential.secret
+        self._get('apiuser', oldsecret)
+        self.credential.secret = 'newsecret'
+        self.credential.put()
+        self._get('apiuser', oldsecret, status=401)
+        self._get('apiuser', 'newsecret')
+
+    def test_revoked_credential(self):
+        """Deleted credentials are rejected even if they were just verified."""
+        self._get('apiuser', self.credential.secret)
+        self.credential.key.delete()
+        self._get('apiuser', self.credential.secret, status=401)
+
+    def tearDown(self):
+        """Remove all credentials"""
+        for key in gaetk.handler.NdbCredential.query().iter(keys_only=True):
+            key.delete()
+
+
+class TestBearerToken(unittest.TestCase):
+    """Stateless bearer tokens."""
+
+    def setUp(self):
+        gaetk.handler.config.BEARER_TOKEN_KEYS = ['this is the current bearer token key']
+        self.credential = gaetk.handler.NdbCredential.create(uid='apiuser', text='test')
+        self.credential.permissions = ['einkaufspreise', 'wertschoepfung']
+        self.credential.put()
+
+        wsgiapp = gaetk.webapp2.WSGIApplication([(r'/', AuthHandler)])
+        wsgiapp = SessionMiddleware(wsgiapp, cookie_key='this should be a 32 character key')
+        self.app = webtest.TestApp(wsgiapp)
+
+    def _get(self, token, status=200):
+        """helper: requests `/` with a bearer token"""
+        headers = {'Authorization': 'Bearer %s' % token, 'Accept': 'application/json'}
+        return self.app.get('/', headers=headers, status=status)
+
+    def test_token(self):
+        """Tokens carry uid and permissions."""
+        token = gaetk.handler.create_bearer_token(self.credential, permissions=['einkaufspreise', 'root'])
+        credential = gaetk.handler.get_bearer_credential(token)
+        self.assertEquals(credential.uid, 'apiuser')
+        self.assertEquals(credential.permissions, ['einkaufspreise'])
+        self.assertFalse(credential.admin)
+        response = self._get(token)
+        self.assertEquals(loads(response.body), {'uid': 'apiuser'})
+
+    def test_invalid_token(self):
+        """Tampered and expired tokens are rejected."""
+        token = gaetk.handler.create_bearer_token(self.credential)
+        self._get(token[:-2], status=401)
+        token = gaetk.handler.create_bearer_token(self.credential, ttl=-1)
+        self._get(token, status=401)
+
+    def test_key_rotation(self):
+        """Tokens signed with an old key are accepted until the key is removed."""
+        token = gaetk.handler.create_bearer_token(self.credential)
+        gaetk.handler.config.BEARER_TOKEN_KEYS = ['this is the new bearer token key',
+                                                  'this is the current bearer token key']
+        self._get(token)
+        newtoken = gaetk.handler.create_bearer_token(self.credential)
+        gaetk.handler.config.BEARER_TOKEN_KEYS = ['this is the new bearer token key']
+        self._get(token, status=401)
+        self._get(newtoken)
+
+    def tearDown(self):
+        """Remove all credentials"""
+        for key in gaetk.handler.NdbCredential.query().iter(keys_only=True):
+            key.delete()
+        del gaetk.handler.config.BEARER_TOKEN_KEYS
+
+
+if __name__ == '__main__':
+    unittest.main()
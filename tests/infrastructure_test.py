@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+infrastructure_test.py
+
+Tests for gaetk.infrastructure
+
+Copyright (c) 2017 HUDORA GmbH. All rights reserved.
+"""
+import datetime
+import os
+import unittest
+
+from gaetk import compat
+from gaetk import infrastructure
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+
+class Result(ndb.Model):
+    size = ndb.IntegerProperty()
+
+
+class Article(ndb.Model):
+    artnr = ndb.StringProperty()
+    name = ndb.StringProperty()
+    tags = ndb.StringProperty(repeated=True)
+    upper_name = ndb.ComputedProperty(lambda self: (self.name or '').upper())
+
+
+class DbArticle(db.Model):
+    artnr = db.StringProperty()
+    name = db.StringProperty()
+    tags = db.StringListProperty()
+
+
+class DbExpandoArticle(db.Expando):
+    artnr = db.StringProperty()
+
+
+def store_size(name, data):
+    Result(id=name, size=len(data)).put()
+
+
+def fail_permanently(data):
+    raise deferred.PermanentTaskFailure('no retry')
+
+
+def store_option(name, _size=0):
+    Result(id=name, size=_size).put()
+
+
+class TrackedRPC(object):
+    """Wraps an RPC and remembers whether it was finished."""
+
+    def __init__(self, rpc, pending, error=None):
+        self.rpc, self.pending, self.error = rpc, pending, error
+        pending.append(self)
+
+    def _finish(self):
+        if self in self.pending:
+            self.pending.remove(self)
+
+    def get_result(self):
+        self._finish()
+        result = self.rpc.get_result()
+        if self.error:
+            raise self.error
+        return result
+
+    def wait(self):
+        self._finish()
+        self.rpc.wait()
+
+
+class TestTaskqueueAddMulti(unittest.TestCase):
+    """Pipelined adding of tasks."""
+
+    def setUp(self):
+        self.taskqueue = apiproxy_stub_map.apiproxy.GetStub('taskqueue')
+        self.taskqueue.FlushQueue('default')
+        self.add_async = taskqueue.Queue.add_async
+        self.pending = []
+        self.max_pending = 0
+        self.fail_batch = None
+
+    def _track(self):
+        """helper: record the RPCs in flight"""
+        test = self
+
+        def add_async(queue, tasks, *args, **kwargs):
+            error = taskqueue.TransientError('simulated') if len(test.pending) == test.fail_batch else None
+            rpc = TrackedRPC(test.add_async(queue, tasks, *args, **kwargs), test.pending, error)
+            test.max_pending = max(test.max_pending, len(test.pending))
+            return rpc
+        taskqueue.Queue.add_async = add_async
+
+    def test_generator(self):
+        """Any iterable works, every batch is reported."""
+        self._track()
+        stats = infrastructure.taskqueue_add_multi(
+            'default', '/task', (dict(nr=i) for i in range(120)), _max_rpcs=2)
+        self.assertEquals([batch['tasks'] for batch in stats], [50, 50, 20])
+        self.assertEquals(sum(batch['skipped'] for batch in stats), 0)
+        self.assertEquals(len(self.taskqueue.GetTasks('default')), 120)
+        self.assertEquals(self.max_pending, 2)
+        self.assertEquals(self.pending, [])
+
+    def test_existing(self):
+        """Existing named tasks are skipped, the rest of their batch is added."""
+        taskqueue.Queue('default').add(taskqueue.Task(url='/task', name='named-1'))
+        tasks = [taskqueue.Task(url='/task', name='named-%d' % i) for i in range(3)]
+        stats = infrastructure._taskqueue_add_pipelined('default', tasks)
+        self.assertEquals(stats[0]['skipped'], 1)
+        self.assertEquals([task.was_enqueued for task in tasks], [True, False, True])
+        self.assertEquals(len(self.taskqueue.GetTasks('default')), 3)
+
+    def test_error(self):
+        """Other errors are raised, but not before all RPCs are finished."""
+        self.fail_batch = 1
+        self._track()
+        self.assertRaises(
+            taskqueue.TransientError, infrastructure.taskqueue_add_multi,
+            'default', '/task', [dict(nr=i) for i in range(200)], _max_rpcs=3)
+        self.assertEquals(self.pending, [])
+
+    def tearDown(self):
+        taskqueue.Queue.add_async = self.add_async
+
+
+class TestCoalescing(unittest.TestCase):
+    """Identical calls within the window result in a single task."""
+
+    def setUp(self):
+        self.taskqueue = apiproxy_stub_map.apiproxy.GetStub('taskqueue')
+        self.taskqueue.FlushQueue('default')
+
+    def test_coalesce(self):
+        for _i in range(10):
+            infrastructure.defer(store_size, 'a', 'data', _queue='default', _coalesce=3600)
+        infrastructure.defer(store_size, 'b', 'data', _queue='default', _coalesce=3600)
+        infrastructure.defer(store_size, 'b', 'data', _queue='default')
+        self.assertEquals(len(self.taskqueue.GetTasks('default')), 3)
+
+    def test_transactional(self):
+        self.assertRaises(ValueError, infrastructure.defer, store_size, 'a', 'data',
+                          _queue='default', _coalesce=60, _transactional=True)
+
+
+class TestLargePayloads(unittest.TestCase):
+    """Payloads exceeding the task size limit go through the datastore."""
+
+    def setUp(self):
+        self.taskqueue = apiproxy_stub_map.apiproxy.GetStub('taskqueue')
+        self.taskqueue.FlushQueue('default')
+
+    def _tasks(self):
+        """helper: returns the bodies of all queued tasks"""
+        tasks = self.taskqueue.GetTasks('default')
+        self.taskqueue.FlushQueue('default')
+        return [task['body'].decode('base64') for task in tasks]
+
+    def test_defer(self):
+        """Large deferred calls are executed and cleaned up."""
+        infrastructure.defer(store_size, 'small', 'x' * 10, _queue='default')
+        infrastructure.defer(store_size, 'large', os.urandom(200000), _queue='default')
+        self.assertEquals(infrastructure.gaetk_TaskPayload.query().count(), 1)
+        for body in self._tasks():
+            deferred.run(body)
+        self.assertEquals(Result.get_by_id('small').size, 10)
+        self.assertEquals(Result.get_by_id('large').size, 200000)
+        self.assertEquals(infrastructure.gaetk_TaskPayload.query().count(), 0)
+
+    def test_serialize_once(self):
+        """The call is pickled only once."""
+        calls = []
+        serialize = deferred.serialize
+        deferred.serialize = lambda *args, **kwargs: calls.append(args) or serialize(*args, **kwargs)
+        try:
+            infrastructure.defer(store_size, 'small', 'x' * 10, _queue='default')
+        finally:
+            deferred.serialize = serialize
+        self.assertEquals([args[0] for args in calls if args[0] is store_size], [store_size])
+        deferred.run(self._tasks()[0])
+        self.assertEquals(Result.get_by_id('small').size, 10)
+
+    def test_underscore_kwargs(self):
+        """Unknown `_`-arguments are passed to the function like `deferred.defer()` does."""
+        infrastructure.defer(store_option, 'option', _size=7, _queue='default')
+        deferred.run(self._tasks()[0])
+        self.assertEquals(Result.get_by_id('option').size, 7)
+
+    def test_permanent_failure(self):
+        """Payloads of tasks which won't be retried are deleted."""
+        infrastructure.defer(fail_permanently, os.urandom(200000), _queue='default')
+        for body in self._tasks():
+            self.assertRaises(deferred.PermanentTaskFailure, deferred.run, body)
+        self.assertEquals(infrastructure.gaetk_TaskPayload.query().count(), 0)
+
+    def test_orphans(self):
+        """Old payloads can be deleted."""
+        infrastructure.gaetk_TaskPayload(data='x').put()
+        self.assertEquals(infrastructure.delete_orphaned_task_payloads(), 0)
+        self.assertEquals(infrastructure.delete_orphaned_task_payloads(datetime.timedelta(0)), 1)
+        self.assertEquals(infrastructure.gaetk_TaskPayload.query().count(), 0)
+
+    def test_payload(self):
+        """Large payloads are decoded transparently."""
+        payloads = [{'nr': 1}, {'nr': 2, 'data': os.urandom(100000).encode('hex')}, {'nr': 3}]
+        infrastructure.taskqueue_add_multi_payload('default', '/task', payloads)
+        bodies = self._tasks()
+        self.assertEquals(len(bodies), 3)
+        self.assertEquals(infrastructure.gaetk_TaskPayload.query().count(), 1)
+        self.assertEquals(
+            sorted(infrastructure.decode_task_payloads(bodies), key=lambda x: x['nr']), payloads)
+        infrastructure.delete_task_payloads(bodies)
+        self.assertEquals(infrastructure.gaetk_TaskPayload.query().count(), 0)
+
+    def tearDown(self):
+        ndb.delete_multi(Result.query().fetch(keys_only=True))
+
+
+class TestWriteOnChange(unittest.TestCase):
+    """Bulk writes only touch changed entities."""
+
+    def _check(self, model):
+        """helper: import twice with some changes"""
+        rows = [dict(artnr='%05d' % i, name='Artikel %d' % i) for i in range(250)]
+        self.assertEquals(infrastructure.write_on_change_multi(model, 'artnr', rows),
+                          dict(created=250, changed=0, unchanged=0))
+        rows[3]['name'] = 'neu'
+        rows[200]['name'] = 'auch neu'
+        rows.append(dict(artnr='99999', name='ganz neu'))
+        self.assertEquals(infrastructure.write_on_change_multi(model, 'artnr', rows, flush_cache=True),
+                          dict(created=1, changed=2, unchanged=248))
+        self.assertEquals(compat.get_by_id_or_name(model, '00003').name, 'neu')
+
+    def test_ndb(self):
+        self._check(Article)
+
+    def test_db(self):
+        self._check(DbArticle)
+
+    def test_expando(self):
+        """Dynamic properties of a db.Expando are compared, too."""
+        self._check(DbExpandoArticle)
+        rows = [dict(artnr='00001', name='Artikel 1', farbe='rot')]
+        self.assertEquals(infrastructure.write_on_change_multi(DbExpandoArticle, 'artnr', rows),
+                          dict(created=0, changed=1, unchanged=0))
+        self.assertEquals(infrastructure.write_on_change_multi(DbExpandoArticle, 'artnr', rows),
+                          dict(created=0, changed=0, unchanged=1))
+        obj = infrastructure.write_on_change(DbExpandoArticle, 'artnr', dict(artnr='00001', farbe='blau'))
+        self.assertEquals(compat.get_by_id_or_name(DbExpandoArticle, '00001').farbe, 'blau')
+        changed, obj = infrastructure.write_on_change_instance(obj, dict(farbe='blau'))
+        self.assertFalse(changed)
+
+    def tearDown(self):
+        ndb.delete_multi(Article.query().fetch(keys_only=True))
+        db.delete(DbArticle.all(keys_only=True).fetch(1000))
+        db.delete(DbExpandoArticle.all(keys_only=True).fetch(1000))
+
+
+class TestReload(unittest.TestCase):
+    """Batched reloading of mixed db and ndb instances."""
+
+    def test_reload_objs(self):
+        objs = [Article(id='1', name='ndb 1'), DbArticle(key_name='2', name='db 2'),
+                Article(id='3', name='ndb 3')]
+        for obj in objs:
+            obj.put()
+        objs[2].key.delete()
+        infrastructure.flush_ndb_cache_multi(objs)
+        self.assertEquals([obj and obj.name for obj in infrastructure.reload_objs(objs)],
+                          ['ndb 1', 'db 2', None])
+
+    def tearDown(self):
+        ndb.delete_multi(Article.query().fetch(keys_only=True))
+        db.delete(DbArticle.all(keys_only=True).fetch(1000))
+
+
+class TestCopyEntity(unittest.TestCase):
+
+    def _check(self, model, key):
+        """helper: copies are independent of the original"""
+        original = model(artnr='1', name='Name', tags=['a'])
+        original.put()
+        copy = infrastructure.copy_entity(original, name='Kopie')
+        copy.tags.append('b')
+        self.assertEquals((copy.artnr, copy.name, copy.tags), ('1', 'Kopie', ['a', 'b']))
+        self.assertEquals((original.name, original.tags), ('Name', ['a']))
+        copies = infrastructure.copy_entities([original, original], keys=[key('v1'), key('v2')])
+        self.assertEquals([compat.xdb_id_or_name(compat.xdb_key(obj)) for obj in copies], ['v1', 'v2'])
+        self.assertEquals([obj.name for obj in copies], ['Name', 'Name'])
+
+    def test_ndb(self):
+        self._check(Article, lambda name: ndb.Key(Article, name))
+        copy = infrastructure.copy_entity(Article(name='abc'))
+        self.assertEquals(copy.upper_name, 'ABC')
+
+    def test_db(self):
+        self._check(DbArticle, lambda name: db.Key.from_path(DbArticle.kind(), name))
+
+    def tearDown(self):
+        ndb.delete_multi(Article.query().fetch(keys_only=True))
+        db.delete(DbArticle.all(keys_only=True).fetch(1000))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,6 +10,7 @@ Copyright (c) 2011 HUDORA GmbH. All rights reserved.
 """
 
 
+from google.appengine.api import datastore
 from google.appengine.ext import db
 import datetime
 import decimal
@@ -107,11 +108,10 @@ class LoggedModelTestCase(unittest.TestCase):
         self.assertEqual(al.changelist,[change])
         self.assertEqual(al.event, 'UPDATE')
 
-    def test_changes_fail(self):
-        """Documentation of misbehaviour for the LoggedModell.
+    def test_changes_in_place(self):
+        """Lists changed in place create AuditLog entries.
 
-        The following changes to an instance of LoggedModel do not create AuditLog entries, which is not the
-        expected behaviour.
+        The values are copied when the instance is loaded, so changing them in place is noticed.
         """
 
         # create an instance
@@ -127,6 +127,180 @@ class LoggedModelTestCase(unittest.TestCase):
 
         # Check 'StringListProperty'
         instance = MyLoggedModel.all().get()
-        instance.stringlistprop.append('this doesnt create an AuditLog entry')
+        instance.stringlistprop.append('this creates an AuditLog entry')
         instance.put()
-        self.assertEqual(gaetk.models.AuditLog.all().count(), 1)  # wrong: count() should result in 2
+        self.assertEqual(gaetk.models.AuditLog.all().count(), 2)
+
+
+class AuditModeTestCase(unittest.TestCase):
+    """Testcase for the different ways of writing AuditLogs"""
+
+    def setUp(self):
+        db.delete(gaetk.models.AuditLog.all(keys_only=True))
+        db.delete(MyLoggedModel.all(keys_only=True))
+
+    def test_modes(self):
+        """All modes create the same AuditLog entries."""
+        for mode in gaetk.models.AUDIT_MODES:
+            instance = MyLoggedModel(key_name=mode, stringprop=u'create')
+            instance.put(audit_mode=mode)
+            instance.stringprop = u'update'
+            instance.put(audit_mode=mode)
+            instance.delete(audit_mode=mode)
+        gaetk.models.flush_audit_logs()
+        for mode in gaetk.models.AUDIT_MODES:
+            query = gaetk.models.AuditLog.all().ancestor(db.Key.from_path('MyLoggedModel', mode))
+            self.assertEqual(sorted(al.event for al in query), ['CREATE', 'DELETE', 'UPDATE'])
+
+    def test_transactional_nested(self):
+        """Transactional mode joins a running transaction."""
+        instance = MyLoggedModel(key_name='nested', stringprop=u'create')
+
+        def txn():
+            instance.put(audit_mode='transactional')
+        db.run_in_transaction(txn)
+        query = gaetk.models.AuditLog.all().ancestor(instance.key())
+        self.assertEqual([al.event for al in query], ['CREATE'])
+
+    def test_buffered(self):
+        """Buffered entries are written on flush."""
+        instance = MyLoggedModel(stringprop=u'create')
+        instance.put(audit_mode='buffered')
+        self.assertEqual(gaetk.models.AuditLog.all().count(), 0)
+        gaetk.models.flush_audit_logs()
+        self.assertEqual(gaetk.models.AuditLog.all().count(), 1)
+
+
+class BulkAuditTestCase(unittest.TestCase):
+    """Testcase for put_multi() and delete_multi()"""
+
+    def setUp(self):
+        db.delete(gaetk.models.AuditLog.all(keys_only=True))
+        db.delete(MyLoggedModel.all(keys_only=True))
+
+    def test_put_multi(self):
+        """One AuditLog per changed entity."""
+        instances = [MyLoggedModel(intprop=i) for i in range(20)]
+        gaetk.models.put_multi(instances)
+        self.assertEqual(gaetk.models.AuditLog.all().filter('event =', 'CREATE').count(), 20)
+        instances[0].intprop = 100
+        gaetk.models.put_multi(instances, audit_mode='async')
+        self.assertEqual(gaetk.models.AuditLog.all().filter('event =', 'UPDATE').count(), 1)
+        al = gaetk.models.AuditLog.all().filter('event =', 'UPDATE').get()
+        self.assertEqual(al.changelist, [u'intprop: 0 \u21d2 100'])
+        gaetk.models.delete_multi(instances)
+        self.assertEqual(gaetk.models.AuditLog.all().filter('event =', 'DELETE').count(), 20)
+        self.assertEqual(MyLoggedModel.all().count(), 0)
+
+
+class AuditQueryTestCase(unittest.TestCase):
+    """Testcase for the AuditLog query API"""
+
+    def setUp(self):
+        db.delete(gaetk.models.AuditLog.all(keys_only=True))
+        db.delete(MyLoggedModel.all(keys_only=True))
+
+    def test_pagination(self):
+        """Entries are paginated newest first and can be filtered."""
+        instance = MyLoggedModel(intprop=0)
+        instance.put()
+        for i in range(1, 25):
+            instance.intprop = i
+            instance.put()
+        entries, cursor, more = instance.get_logentries(limit=10)
+        self.assertEqual(len(entries), 10)
+        self.assertTrue(more)
+        self.assertEqual(entries[0].changelist, [u'intprop: 23 \u21d2 24'])
+        seen = len(entries)
+        while more:
+            entries, cursor, more = instance.get_logentries(limit=10, cursor=cursor)
+            seen += len(entries)
+        self.assertEqual(seen, 25)
+        entries, cursor, more = instance.get_logentries(event='CREATE')
+        self.assertEqual([al.event for al in entries], ['CREATE'])
+
+    def test_daily_summary(self):
+        """Entries are counted per day."""
+        instance = MyLoggedModel(intprop=0)
+        instance.put()
+        instance.intprop = 1
+        instance.put()
+        summary = gaetk.models.AuditLog.daily_summary(instance)
+        self.assertEqual(len(summary), 1)
+        self.assertEqual((summary[0]['CREATE'], summary[0]['UPDATE'], summary[0]['total']), (1, 1, 2))
+
+
+class CompactChangelistTestCase(unittest.TestCase):
+    """Testcase for the AuditLog changelist encoding"""
+
+    def setUp(self):
+        db.delete(gaetk.models.AuditLog.all(keys_only=True))
+        db.delete(MyLoggedModel.all(keys_only=True))
+
+    def test_encoding(self):
+        """Changes are stored as JSON, large ones compressed, and formatted when read."""
+        threshold = gaetk.models.AUDIT_COMPRESS_THRESHOLD
+        gaetk.models.AUDIT_COMPRESS_THRESHOLD = 100
+        try:
+            instance = MyLoggedModel(stringprop=u'\xe4', textprop=u'x' * 2000, stringlistprop=[u'a'])
+            instance.put()
+        finally:
+            gaetk.models.AUDIT_COMPRESS_THRESHOLD = threshold
+        al = gaetk.models.AuditLog.all().get()
+        self.assertFalse(al.changes.startswith('['))
+        self.assertTrue(u'stringprop: None \u21d2 \xe4' in al.changelist)
+        instance.delete()
+        al = gaetk.models.AuditLog.all().filter('event =', 'DELETE').get()
+        self.assertTrue(u"stringlistprop: [u'a']" in al.changelist)
+
+    def test_legacy(self):
+        """Old entries with formatted strings can still be read."""
+        instance = MyLoggedModel(key_name='legacy')
+        instance.put()
+        al = gaetk.models.AuditLog.create(instance, 'UPDATE', [u'intprop: 1 \u21d2 2'])
+        al = gaetk.models.AuditLog.get(al.key())
+        self.assertEqual(al.changelist, [u'intprop: 1 \u21d2 2'])
+
+
+class ScaledDecimal(db.Model):
+    """Model with a DecimalProperty stored as cents."""
+
+    preis = gaetk.models.DecimalProperty(precision=2)
+
+
+class DecimalPropertyTestCase(unittest.TestCase):
+    """Testcase for DecimalProperty(precision=...)"""
+
+    def test_roundtrip(self):
+        """Values are stored as scaled integers and rounded half up."""
+        for value, stored, loaded in [('1.50', 150, '1.50'), ('-1.005', -101, '-1.01'),
+                                      ('1E+3', 100000, '1000.00'), ('0', 0, '0.00')]:
+            instance = ScaledDecimal(preis=decimal.Decimal(value))
+            instance.put()
+            self.assertEqual(instance._entity['preis'], stored)
+            self.assertEqual(str(ScaledDecimal.get(instance.key()).preis), loaded)
+        instance = ScaledDecimal(preis=None)
+        instance.put()
+        self.assertEqual(ScaledDecimal.get(instance.key()).preis, None)
+
+    def test_positional_arguments(self):
+        """`precision` doesn't change the signature of `db.Property`."""
+        prop = gaetk.models.DecimalProperty('Preis', 'preis', precision=2)
+        self.assertEqual((prop.verbose_name, prop.name, prop.precision), ('Preis', 'preis', 2))
+        self.assertEqual(gaetk.models.DecimalProperty('Preis', 'preis').precision, None)
+
+    def test_legacy_strings(self):
+        """Values written as strings can still be read."""
+        self.assertEqual(ScaledDecimal.preis.make_value_from_datastore('12.34'), decimal.Decimal('12.34'))
+
+    def test_decimal_columns(self):
+        """Raw entities are converted column by column."""
+        for value in ['1.50', '-2.25', None]:
+            ScaledDecimal(preis=None if value is None else decimal.Decimal(value)).put()
+        entities = list(datastore.Query('ScaledDecimal').Run())
+        columns = gaetk.models.decimal_columns(ScaledDecimal, entities)
+        self.assertEqual(sorted(columns['preis']),
+                         sorted([decimal.Decimal('1.50'), decimal.Decimal('-2.25'), None]))
+        entities[0]['preis'] = '12.34'
+        columns = gaetk.models.decimal_columns(ScaledDecimal, entities)
+        self.assertEqual(columns['preis'][0], decimal.Decimal('12.34'))
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+lru_cache_test.py
+
+Tests for gaetk.lib._lru_cache.TimedLRUCache
+
+Copyright (c) 2017 HUDORA GmbH. All rights reserved.
+"""
+import unittest
+
+from gaetk.lib._lru_cache import TimedLRUCache
+
+
+class TestTimedLRUCache(unittest.TestCase):
+
+    def test_lru(self):
+        """The least recently used entry is dropped first."""
+        cache = TimedLRUCache(2)
+        cache.set('a', 1, 60)
+        cache.set('b', 2, 60)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3, 60)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+
+    def test_expiry(self):
+        """Expired entries are not returned."""
+        cache = TimedLRUCache(10)
+        cache.set('a', 1, -1)
+        self.assertEqual(cache.get('a', 'default'), 'default')
+
+    def test_delete(self):
+        """Entries can be removed by key or by value."""
+        cache = TimedLRUCache(10)
+        for i in range(4):
+            cache.set(i, i, 60)
+        cache.delete(0)
+        cache.delete_matching(lambda value: value % 2)
+        self.assertEqual([cache.get(i) for i in range(4)], [None, None, 2, None])
+        cache.clear()
+        self.assertEqual(cache.get(2), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+mapper_test.py
+
+Tests for gaetk.mapper
+
+Copyright (c) 2017 HUDORA GmbH. All rights reserved.
+"""
+import unittest
+
+import gaetk.mapper
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+
+class Item(ndb.Model):
+    value = ndb.IntegerProperty()
+    mapped = ndb.IntegerProperty()
+
+
+class DbItem(db.Model):
+    value = db.IntegerProperty()
+    mapped = db.IntegerProperty()
+
+
+def query_items(minimum):
+    return Item.query(Item.value >= minimum)
+
+
+def query_db_items(minimum):
+    return DbItem.all().filter('value >=', minimum)
+
+
+def double(item):
+    item.mapped = item.value * 2
+    item.put()
+    return {'sum': item.mapped}
+
+
+def fail(item):
+    raise RuntimeError('fail')
+
+
+def callback(job):
+    Item(id='callback', mapped=job.counters['entities']).put()
+
+
+class TestMapper(unittest.TestCase):
+
+    def setUp(self):
+        ndb.put_multi([Item(value=i) for i in range(25)])
+        self.taskqueue = apiproxy_stub_map.apiproxy.GetStub('taskqueue')
+        self.taskqueue.FlushQueue('default')
+
+    def _run_tasks(self):
+        """helper: execute deferred tasks until the queue is empty, returns failed tasks"""
+        failed = 0
+        while True:
+            tasks = self.taskqueue.GetTasks('default')
+            if not tasks:
+                return failed
+            self.taskqueue.FlushQueue('default')
+            for task in tasks:
+                try:
+                    deferred.run(task['body'].decode('base64'))
+                except deferred.PermanentTaskFailure:
+                    failed += 1
+                except Exception:
+                    # retry like the task queue would
+                    deferred.defer(deferred.run, task['body'].decode('base64'), _queue='default')
+
+    def test_job(self):
+        """All entities are mapped once and counters are combined."""
+        job_key = gaetk.mapper.start_job(
+            query_items, double, query_args=(5,), callback=callback, shard_size=6, queue='default')
+        self._run_tasks()
+        job = job_key.get()
+        self.assertEquals(job.status, 'done')
+        self.assertEquals(job.shard_count, 4)
+        self.assertEquals(job.counters, {'entities': 20, 'sum': 2 * sum(range(5, 25))})
+        self.assertEquals(sorted(item.mapped for item in query_items(5)), [i * 2 for i in range(5, 25)])
+        self.assertEquals(Item.get_by_id('callback').mapped, 20)
+
+    def test_db_job(self):
+        """db queries are split as well."""
+        db.put([DbItem(value=i) for i in range(25)])
+        job_key = gaetk.mapper.start_job(
+            query_db_items, double, query_args=(5,), shard_size=6, queue='default')
+        self._run_tasks()
+        job = job_key.get()
+        self.assertEquals((job.status, job.shard_count), ('done', 4))
+        self.assertEquals(job.counters, {'entities': 20, 'sum': 2 * sum(range(5, 25))})
+
+    def test_check_task_lost(self):
+        """The job finishes even if no `_check_job` task can be added."""
+        defer = gaetk.mapper.defer
+
+        def swallow_checks(obj, *args, **kwargs):
+            """Like a task which did already run: `defer()` returns `None`."""
+            if obj is not gaetk.mapper._check_job:
+                return defer(obj, *args, **kwargs)
+
+        gaetk.mapper.defer = swallow_checks
+        try:
+            job_key = gaetk.mapper.start_job(
+                query_items, double, query_args=(5,), shard_size=6, queue='default')
+            self._run_tasks()
+        finally:
+            gaetk.mapper.defer = defer
+        self.assertEquals(job_key.get().status, 'done')
+
+    def test_failing_shard(self):
+        """Shards are retried and finally given up."""
+        job_key = gaetk.mapper.start_job(query_items, fail, query_args=(20,), queue='default')
+        self.assertEquals(self._run_tasks(), 1)
+        job = job_key.get()
+        self.assertEquals(job.status, 'failed')
+        self.assertEquals(job.shards_failed, 1)
+        shard = gaetk.mapper.gaetk_JobShard.get_by_id('%s-0' % job_key.id())
+        self.assertEquals(shard.retries, gaetk.mapper.MAX_SHARD_RETRIES)
+
+    def tearDown(self):
+        ndb.delete_multi(Item.query().fetch(keys_only=True))
+        db.delete(DbItem.all(keys_only=True).fetch(1000))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+permissions_test.py
+
+Tests for gaetk.handler.PermissionSet
+
+Copyright (c) 2017 HUDORA GmbH. All rights reserved.
+"""
+import unittest
+
+import gaetk
+
+
+class TestPermissionSet(unittest.TestCase):
+    """Permission lookups with wildcards and roles."""
+
+    def setUp(self):
+        gaetk.handler.config.PERMISSION_ROLES = {
+            'buchhaltung': ['einkaufspreise', 'reports.*'],
+            'chef': ['buchhaltung', 'wertschoepfung']}
+
+    def test_wildcards(self):
+        permissions = gaetk.handler.PermissionSet(['einkaufspreise', 'reports.*'])
+        self.assertTrue('einkaufspreise' in permissions)
+        self.assertTrue('reports.sales' in permissions)
+        self.assertTrue('reports.sales.daily' in permissions)
+        self.assertFalse('reports' in permissions)
+        self.assertFalse('wertschoepfung' in permissions)
+        self.assertTrue('anything' in gaetk.handler.PermissionSet(['*']))
+
+    def test_roles(self):
+        credential = gaetk.handler.BearerCredential('user', ['chef'])
+        permissions = gaetk.handler.get_permission_set(credential)
+        self.assertEquals(permissions.check(['einkaufspreise', 'reports.x', 'wertschoepfung', 'root']),
+                          {'einkaufspreise': True, 'reports.x': True, 'wertschoepfung': True, 'root': False})
+        self.assertTrue(gaetk.handler.get_permission_set(credential) is permissions)
+        # replacing the permissions is picked up
+        credential.permissions = ['wertschoepfung']
+        self.assertFalse('einkaufspreise' in gaetk.handler.get_permission_set(credential))
+
+    def test_no_credential(self):
+        self.assertFalse('einkaufspreise' in gaetk.handler.get_permission_set(None))
+
+    def tearDown(self):
+        del gaetk.handler.config.PERMISSION_ROLES
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+snippets_test.py
+
+Tests for the caching in gaetk.snippets
+
+Copyright (c) 2017 HUDORA GmbH. All rights reserved.
+"""
+import os
+import time
+import unittest
+
+import jinja2
+
+from gaetk import snippets
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+from google.appengine.ext import deferred
+from google.appengine.ext import ndb
+
+
+class TestSnippetCache(unittest.TestCase):
+
+    def setUp(self):
+        memcache.flush_all()
+        snippets._template_cache.clear()
+        ndb.delete_multi(snippets.gaetk_Snippet.query().fetch(keys_only=True))
+        ndb.delete_multi(snippets.gaetk_SnippetUsage.query().fetch(keys_only=True))
+        snippets._template_snippets.clear()
+        snippets._usage.clear()
+        snippets._usage_defaults.clear()
+        snippets._usage_flushed_at[0] = time.time()
+        self.env = jinja2.Environment(loader=jinja2.DictLoader({
+            'page.html': u"{{ show_snippet('a') }}{{ show_snippet('b') }}{{ show_snippet('a') }}"}))
+        self.env.globals['show_snippet'] = snippets.show_snippet
+
+    def _render(self, source, **values):
+        """helper: render `source` with the test environment"""
+        return self.env.from_string(source).render(values)
+
+    def test_static(self):
+        """Snippets without variables are rendered once until they are edited."""
+        snippets.gaetk_Snippet(id='intro', name='intro', markdown=u'Hallo *Welt*').put()
+        self.assertTrue(u'<em>Welt</em>' in self._render(u"{{ show_snippet('intro') }}"))
+        self.assertTrue(u'<em>Welt</em>' in memcache.get(snippets._rendered_cache_key('intro'))[1])
+        snippets.gaetk_Snippet(id='intro', name='intro', markdown=u'Neu').put()
+        self.assertTrue(u'<em>Welt</em>' in self._render(u"{{ show_snippet('intro') }}"))
+        snippets.invalidate_snippet('intro')
+        self.assertTrue(u'Neu' in self._render(u"{{ show_snippet('intro') }}"))
+
+    def test_context(self):
+        """Snippets using variables are rendered every time, but compiled only once."""
+        snippets.gaetk_Snippet(id='gruss', name='gruss', markdown=u'Hallo {{ kunde }}').put()
+        self.assertTrue(u'Hallo A' in self._render(u"{{ show_snippet('gruss') }}", kunde='A'))
+        self.assertTrue(u'Hallo B' in self._render(u"{{ show_snippet('gruss') }}", kunde='B'))
+        self.assertEqual(memcache.get(snippets._rendered_cache_key('gruss')), None)
+        self.assertEqual(len(snippets._template_cache._data), 1)
+
+    def test_globals(self):
+        """Globals change for every request, snippets using them are not cached."""
+        snippets.gaetk_Snippet(id='gruss', name='gruss', markdown=u'Hallo {{ kunde }}').put()
+        self.env.globals['kunde'] = 'A'
+        self.assertTrue(u'Hallo A' in self._render(u"{{ show_snippet('gruss') }}"))
+        self.env.globals['kunde'] = 'B'
+        self.assertTrue(u'Hallo B' in self._render(u"{{ show_snippet('gruss') }}"))
+        self.assertEqual(memcache.get(snippets._rendered_cache_key('gruss')), None)
+
+    def test_context_filter(self):
+        """Context filters read the request, snippets using them are not cached."""
+        self.env.filters['kunde'] = jinja2.contextfilter(lambda ctx, value: ctx.get('kunde'))
+        snippets.gaetk_Snippet(id='gruss', name='gruss', markdown=u"Hallo {{ 'x'|kunde }}").put()
+        self.assertTrue(u'Hallo A' in self._render(u"{{ show_snippet('gruss') }}", kunde='A'))
+        self.assertTrue(u'Hallo B' in self._render(u"{{ show_snippet('gruss') }}", kunde='B'))
+        self.assertEqual(memcache.get(snippets._rendered_cache_key('gruss')), None)
+
+    def test_invalidate_race(self):
+        """Content rendered before an edit is not used afterwards."""
+        snippets.gaetk_Snippet(id='intro', name='intro', markdown=u'Alt').put()
+        content, snippet, version = snippets.prefetch_snippets(['intro'])['intro']
+        self.assertEqual((content, snippet.markdown), (None, u'Alt'))
+        # edited while the old snippet is being rendered
+        snippets.gaetk_Snippet(id='intro', name='intro', markdown=u'Neu').put()
+        snippets.invalidate_snippet('intro')
+        memcache.set(snippets._rendered_cache_key('intro'), (version, u'Alt'))
+        self.assertTrue(u'Neu' in self._render(u"{{ show_snippet('intro') }}"))
+        self.assertTrue(u'Neu' in self._render(u"{{ show_snippet('intro') }}"))
+
+    def test_prefetch(self):
+        """Snippets used by a template are recorded and loaded together."""
+        for name in ['a', 'b']:
+            snippets.gaetk_Snippet(id=name, name=name, markdown=u'Snippet %s' % name).put()
+        self.env.get_template('page.html').render()
+        self.assertEqual(snippets._template_snippets['page.html'], frozenset(['a', 'b']))
+        loaded = []
+        prefetch_snippets = snippets.prefetch_snippets
+        snippets.prefetch_snippets = (
+            lambda db_names: loaded.append(sorted(db_names)) or prefetch_snippets(db_names))
+        try:
+            content = self.env.get_template('page.html').render()
+        finally:
+            snippets.prefetch_snippets = prefetch_snippets
+        self.assertEqual(loaded, [['a', 'b']])
+        self.assertEqual(content.count(u'Snippet a'), 2)
+
+    def test_usage(self):
+        """Rendering doesn't write, usage is stored later."""
+        os.environ['PATH_INFO'] = '/seite/'
+        self.env.get_template('page.html').render()
+        self.assertEqual(snippets.gaetk_Snippet.query().count(), 0)
+        self.assertEqual(snippets._usage[('a', '/seite/')], 2)
+        snippets._store_usage(dict(snippets._usage), dict(snippets._usage_defaults))
+        usage = snippets.get_snippet_usage(['a', 'b', 'c'])
+        self.assertEqual(sorted(usage.keys()), ['a', 'b'])
+        self.assertEqual((usage['a'].count, usage['a'].paths), (2, {'/seite/': 2}))
+        self.assertEqual(snippets.gaetk_Snippet.get_by_id('b').path_info, '/seite/')
+
+    def test_usage_middleware(self):
+        """The usage is stored by the middleware, not while rendering."""
+        taskqueue = apiproxy_stub_map.apiproxy.GetStub('taskqueue')
+        taskqueue.FlushQueue('default')
+
+        def app(environ, start_response):
+            """helper: render a page"""
+            return [self.env.get_template('page.html').render().encode('utf-8')]
+
+        app = snippets.SnippetUsageMiddleware(app)
+        queue = snippets.SNIPPET_USAGE_QUEUE
+        snippets.SNIPPET_USAGE_QUEUE = 'default'
+        try:
+            app({}, None)
+            self.assertEqual(taskqueue.GetTasks('default'), [])
+            # new snippets are created with the next request
+            app({}, None)
+        finally:
+            snippets.SNIPPET_USAGE_QUEUE = queue
+        tasks = taskqueue.GetTasks('default')
+        self.assertEqual(len(tasks), 1)
+        deferred.run(tasks[0]['body'].decode('base64'))
+        self.assertEqual(sorted(snippets.get_snippet_usage().keys()), ['a', 'b'])
+        self.assertEqual(snippets.gaetk_Snippet.query().count(), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()